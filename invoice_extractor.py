@@ -12,30 +12,48 @@ Optimizations:
 - Multi-strategy JSON parsing
 - Cross-validation of extracted values
 - Parallel page processing support
+- Multi-page batched prompts (one shared prompt per page group)
 - Comprehensive logging
 """
 
+import contextvars
+import hashlib
 import logging
+import multiprocessing
+import os
+import random
 import time
 import threading
+from collections import deque
 from io import BytesIO
-from typing import Dict, Optional, List, Tuple
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from itertools import islice
+from multiprocessing import shared_memory
+from typing import Dict, Optional, List, Tuple, Iterable, Iterator
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    TimeoutError as FuturesTimeoutError
+)
 
 import google.generativeai as genai
+from cachetools import TTLCache
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-import requests
+import httpx
 from PIL import Image
 
-from preprocessor import ImagePreprocessor, PDFPageConverter
-from parser import JSONParser, ResponseValidator
+from preprocessor import ImagePreprocessor, preprocess_image_bytes, render_shared_pdf_pages
+from parser import JSONParser, ResponseValidator, TextLineItemExtractor
 from prompts import (
     EXTRACTION_PROMPT_V1,
     RETRY_PROMPT,
     select_prompt,
+    classify_page_text,
+    get_batch_prompt,
     get_text_enhanced_prompt,
+    prompt_fingerprint,
+    select_config,
     GENERATION_CONFIG,
-    RETRY_GENERATION_CONFIG
+    BATCH_RESPONSE_SCHEMA
 )
 
 logger = logging.getLogger(__name__)
@@ -45,9 +63,200 @@ MAX_PAGES = 25
 MAX_REQUEST_TIMEOUT = 180  # seconds
 PAGE_TIMEOUT = 30  # seconds per page
 DOWNLOAD_TIMEOUT = 60  # seconds
-MAX_WORKERS = 3
-API_DELAY = 1.0  # Delay between API calls
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # bytes
+MAX_WORKERS = int(os.getenv("GEMINI_PAGE_WORKERS", 8))  # Page threads (mostly waiting on I/O)
+# Below the thread count: page threads also spend time in the RPM wait,
+# retry backoff, response parsing and page cache hits, none of which hold
+# a Gemini call open, and the pool is shared by concurrent extractions
+GEMINI_INFLIGHT = int(os.getenv("GEMINI_INFLIGHT", 4))  # Max concurrent Gemini calls
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", 60))  # Gemini requests per minute, per process
+RETRY_BACKOFF = 2.0  # Base delay (seconds) after a failed API call
 MAX_RETRIES = 2
+PAGE_BATCH_SIZE = 6  # Pages rendered ahead of extraction (two batches held in memory)
+# Render processes per uvicorn worker; the default splits the CPUs across
+# WEB_CONCURRENCY workers so they don't oversubscribe the machine
+RENDER_WORKERS = int(os.getenv(
+    "RENDER_WORKERS",
+    max(1, (os.cpu_count() or 1) // max(1, int(os.getenv("WEB_CONCURRENCY", 1))))
+))
+JPEG_MAGIC = b'\xff\xd8\xff'
+MAX_OUTPUT_TOKENS = 8192  # Budget for batches and retries after truncation
+BATCH_PAGES = 4  # Max pages sharing one Gemini call
+BATCH_TEXT_BUDGET = 6000  # Max combined text layer chars per batched call
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 256))  # 0 disables caching
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 3600))  # seconds
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", 2048))  # Cached page results, 0 disables
+BATCH_PAGE_TEXT_CHARS = 3000  # Text layer chars included per page
+
+# Pooled HTTP/2 client for document downloads; keeps TLS connections
+# to frequently used origins alive between requests
+_HTTP_CLIENT = httpx.Client(
+    http2=True,
+    timeout=DOWNLOAD_TIMEOUT,
+    follow_redirects=True,
+    limits=httpx.Limits(
+        max_connections=64,
+        max_keepalive_connections=32,
+        keepalive_expiry=60.0
+    )
+)
+
+# Shared pool for page extraction calls, reused across requests
+_PAGE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=MAX_WORKERS,
+    thread_name_prefix="gemini-page"
+)
+
+# CPU-bound rasterization and preprocessing run in worker processes, apart
+# from the I/O-bound request and Gemini threads. PyMuPDF documents are also
+# not thread-safe, so each worker opens its own copy of the PDF. Workers are
+# spawned lazily on first use and reused across requests.
+_RENDER_EXECUTOR = ProcessPoolExecutor(
+    max_workers=RENDER_WORKERS,
+    mp_context=multiprocessing.get_context("spawn")
+)
+
+
+class RateLimiter:
+    """
+    Sliding-window rate limiter for outgoing API calls.
+    
+    Callers only block once `max_calls` calls have been made within the
+    last `period` seconds, instead of sleeping before every call.
+    """
+    
+    def __init__(self, max_calls: int, period: float = 60.0):
+        """
+        Args:
+            max_calls: Calls allowed per window
+            period: Window length in seconds
+        """
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._condition = threading.Condition()
+    
+    def acquire(self):
+        """Block until a call is allowed, then record it."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                
+                # Wait until the oldest call leaves the window
+                self._condition.wait(self.period - (now - self._calls[0]))
+
+
+class ResultCache:
+    """
+    Thread-safe LRU+TTL cache of final extraction results.
+    
+    Results are stored under both the document URL and a hash of the
+    downloaded bytes, so a re-submitted URL skips the download and a new
+    URL serving an identical document skips extraction.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        Args:
+            maxsize: Max entries per key type (0 disables the cache)
+            ttl: Seconds an entry stays valid
+        """
+        self.enabled = maxsize > 0
+        self._by_url = TTLCache(maxsize=max(1, maxsize), ttl=ttl)
+        self._by_content = TTLCache(maxsize=max(1, maxsize), ttl=ttl)
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def content_key(content: bytes) -> bytes:
+        """Hash document bytes into a cache key."""
+        return hashlib.sha256(content).digest()
+    
+    def get_by_url(self, url: str) -> Optional[Dict]:
+        """Look up a result by document URL."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            return self._by_url.get(url)
+    
+    def get_by_content(self, key: bytes) -> Optional[Dict]:
+        """Look up a result by document content hash."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            return self._by_content.get(key)
+    
+    def put(self, url: str, key: bytes, result: Dict):
+        """Store a result under both its URL and content hash."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._by_url[url] = result
+            self._by_content[key] = result
+
+
+class PageCache:
+    """
+    Thread-safe LRU+TTL cache of validated single-page results.
+    
+    Keyed on the prompt sent and a hash of the page image, so a page that
+    reappears in another document (or a re-exported copy of the same one)
+    is answered without a Gemini call.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        Args:
+            maxsize: Max cached pages (0 disables the cache)
+            ttl: Seconds an entry stays valid
+        """
+        self.enabled = maxsize > 0
+        self._pages = TTLCache(maxsize=max(1, maxsize), ttl=ttl)
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(prompt_key: bytes, image: dict) -> Tuple[bytes, bytes]:
+        """Build a cache key from a prompt fingerprint and an image blob."""
+        return prompt_key, hashlib.sha256(image['data']).digest()
+    
+    def get(self, key: Tuple[bytes, bytes]) -> Optional[Dict]:
+        """Look up a page result; returns a copy the caller may modify."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            cached = self._pages.get(key)
+        return dict(cached) if cached is not None else None
+    
+    def put(self, key: Tuple[bytes, bytes], result: Dict):
+        """Store a copy of a page result."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pages[key] = dict(result)
+
+
+# Token tally for the request running in the current context. Page threads
+# are submitted with a copy of the request's context, so concurrent
+# requests on the shared extractor each count only their own calls.
+_REQUEST_TOKENS: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar(
+    "request_tokens", default=None
+)
+
+# Start time and cancel event of the request running in the current
+# context, kept per request for the same reason as _REQUEST_TOKENS
+_REQUEST_CONTROL: contextvars.ContextVar[Optional[Tuple[float, Optional[threading.Event]]]] = (
+    contextvars.ContextVar("request_control", default=None)
+)
+
+# Shared across extractor instances so repeated documents hit regardless
+# of which instance served the first request
+_RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+_PAGE_CACHE = PageCache(PAGE_CACHE_SIZE, RESULT_CACHE_TTL)
 
 
 class InvoiceExtractor:
@@ -76,14 +285,21 @@ class InvoiceExtractor:
         self.preprocessor = ImagePreprocessor(target_max_dim=1600)
         self.parser = JSONParser()
         self.validator = ResponseValidator()
+        self.text_extractor = TextLineItemExtractor()
         
         # Token tracking (thread-safe)
         self._token_lock = threading.Lock()
         self.total_input_tokens = 0
         self.total_output_tokens = 0
         
-        # Request timing
-        self._request_start = None
+        # Pages served from the PDF text layer without a Gemini call
+        self.fast_path_hits = 0
+        
+        # Shared across worker threads so page calls only wait at the RPM limit
+        self._rate_limiter = RateLimiter(GEMINI_RPM)
+        
+        # Bounds in-flight Gemini calls independently of the thread count
+        self._llm_semaphore = threading.BoundedSemaphore(GEMINI_INFLIGHT)
         
         # Safety settings - disable all filters for medical content
         self.safety_settings = {
@@ -95,6 +311,43 @@ class InvoiceExtractor:
         
         logger.info("InvoiceExtractor initialized with Gemini 2.5 Flash")
     
+    def warm_up(self) -> float:
+        """
+        Make a minimal Gemini call to establish the API connection.
+        
+        Returns:
+            Seconds taken by the call
+        """
+        t0 = time.time()
+        self._generate(
+            ["Reply with OK.", Image.new('RGB', (1, 1), (255, 255, 255))],
+            {"temperature": 0, "max_output_tokens": 1}
+        )
+        return time.time() - t0
+    
+    def _generate(self, contents: list, gen_config: Dict):
+        """
+        Call Gemini within the RPM limit and the in-flight call bound.
+        
+        Args:
+            contents: Prompt parts and images
+            gen_config: Generation config dict
+            
+        Returns:
+            Raw Gemini response
+        """
+        self._rate_limiter.acquire()
+        with self._llm_semaphore:
+            return self.model.generate_content(
+                contents,
+                generation_config=genai.types.GenerationConfig(**gen_config),
+                safety_settings=self.safety_settings
+            )
+    
+    def has_cached_result(self, url: str) -> bool:
+        """Check whether extract_from_url would be served from the URL cache."""
+        return _RESULT_CACHE.get_by_url(url) is not None
+    
     def reset_token_count(self):
         """Reset token counters for new request."""
         with self._token_lock:
@@ -106,6 +359,11 @@ class InvoiceExtractor:
         with self._token_lock:
             self.total_input_tokens += input_tokens
             self.total_output_tokens += output_tokens
+            
+            usage = _REQUEST_TOKENS.get()
+            if usage is not None:
+                usage['input_tokens'] += input_tokens
+                usage['output_tokens'] += output_tokens
     
     def get_token_usage(self) -> Dict[str, int]:
         """Get current token usage."""
@@ -118,44 +376,82 @@ class InvoiceExtractor:
     
     def _check_timeout(self, stage: str = "") -> bool:
         """Check if approaching request timeout."""
-        if self._request_start is None:
+        control = _REQUEST_CONTROL.get()
+        if control is None:
             return False
-        elapsed = time.time() - self._request_start
+        elapsed = time.time() - control[0]
         if elapsed > MAX_REQUEST_TIMEOUT - 20:
             logger.warning(f"Approaching timeout at {stage}: {elapsed:.1f}s")
             return True
         return False
     
-    def extract_from_url(self, url: str) -> Dict:
+    def _check_cancelled(self, stage: str = "") -> bool:
+        """Check if the caller has abandoned the current request."""
+        control = _REQUEST_CONTROL.get()
+        cancel_event = control[1] if control is not None else None
+        if cancel_event is not None and cancel_event.is_set():
+            logger.warning(f"Request cancelled at {stage}")
+            return True
+        return False
+    
+    def extract_from_url(self, url: str,
+                         cancel_event: Optional[threading.Event] = None
+                         ) -> Tuple[Dict, Dict[str, int]]:
         """
         Main entry point: Extract from document URL.
         
         Args:
             url: URL to PDF or image document
+            cancel_event: Optional event that stops further page work once set
+                (e.g. on client disconnect or request timeout)
             
         Returns:
-            Extraction results dict with pagewise_line_items and total_item_count
+            Tuple of (extraction results dict with pagewise_line_items and
+            total_item_count, plus cache_hit=True when served from the result
+            cache; token usage of this call only)
         """
+        usage = {"input_tokens": 0, "output_tokens": 0}
+        request_start = time.time()
+        context_token = _REQUEST_TOKENS.set(usage)
+        control_token = _REQUEST_CONTROL.set((request_start, cancel_event))
+        try:
+            result = self._extract_from_url(url, request_start)
+        finally:
+            _REQUEST_CONTROL.reset(control_token)
+            _REQUEST_TOKENS.reset(context_token)
+        
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        return result, usage
+    
+    def _extract_from_url(self, url: str, request_start: float) -> Dict:
+        """Run the download and extraction stages for extract_from_url."""
         self.reset_token_count()
-        self._request_start = time.time()
         
         timings = {}
         
+        cached = _RESULT_CACHE.get_by_url(url)
+        if cached is not None:
+            logger.info("[CACHE] URL hit, skipping download and extraction")
+            return {**cached, "cache_hit": True}
+        
         try:
             # Stage 1: Download document
             t0 = time.time()
             logger.info(f"[DOWNLOAD] Starting download...")
             
-            response = requests.get(url, timeout=DOWNLOAD_TIMEOUT, stream=True)
-            response.raise_for_status()
-            
-            content = response.content
-            content_type = response.headers.get('Content-Type', '').lower()
+            content, content_type = self._download(url)
             
             timings['download'] = time.time() - t0
             logger.info(f"[DOWNLOAD] Completed in {timings['download']:.1f}s "
                        f"({len(content)/1024:.1f}KB, type: {content_type})")
             
+            content_key = ResultCache.content_key(content)
+            cached = _RESULT_CACHE.get_by_content(content_key)
+            if cached is not None:
+                logger.info("[CACHE] Content hit, skipping extraction")
+                _RESULT_CACHE.put(url, content_key, cached)
+                return {**cached, "cache_hit": True}
+            
             # Stage 2: Detect file type and extract
             is_pdf = self._is_pdf(url, content, content_type)
             
@@ -167,23 +463,49 @@ class InvoiceExtractor:
                 result = self._extract_from_image(content, timings)
             
             # Log final timings
-            total_time = time.time() - self._request_start
+            total_time = time.time() - request_start
             logger.info(f"[COMPLETE] Total time: {total_time:.1f}s, "
                        f"Items: {result.get('total_item_count', 0)}, "
                        f"Pages: {len(result.get('pagewise_line_items', []))}")
             
+            # Empty results may come from transient API failures, so only
+            # cache extractions that found items
+            if result.get('total_item_count', 0) > 0 and not self._check_cancelled("cache"):
+                _RESULT_CACHE.put(url, content_key, result)
+            
             return result
             
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             logger.error(f"[ERROR] Download timeout after {DOWNLOAD_TIMEOUT}s")
             raise Exception(f"Document download timeout ({DOWNLOAD_TIMEOUT}s)")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"[ERROR] Download failed: {str(e)}")
             raise
         except Exception as e:
             logger.error(f"[ERROR] Extraction failed: {str(e)}")
             raise
     
+    def _download(self, url: str) -> Tuple[bytes, str]:
+        """
+        Stream a document into memory.
+        
+        Chunks are written straight into one buffer instead of being
+        joined at the end, so the body is held only once.
+        
+        Returns:
+            Tuple of (document bytes, lowercased Content-Type)
+        """
+        with _HTTP_CLIENT.stream("GET", url) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '').lower()
+            
+            buffer = BytesIO()
+            for chunk in response.iter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                buffer.write(chunk)
+        
+        # getvalue() shares the buffer's bytes rather than copying them
+        return buffer.getvalue(), content_type
+    
     def _is_pdf(self, url: str, content: bytes, content_type: str) -> bool:
         """Determine if document is PDF."""
         return (
@@ -195,62 +517,69 @@ class InvoiceExtractor:
     def _extract_from_pdf(self, pdf_content: bytes, timings: dict) -> Dict:
         """
         Extract from PDF document with parallel page processing.
+        
+        Pages are rendered lazily in batches of PAGE_BATCH_SIZE across
+        worker processes, one batch ahead of extraction, so at most two
+        batches of page images are held in memory at a time.
         """
         try:
             import fitz  # PyMuPDF
             
-            t0 = time.time()
             pdf = fitz.open(stream=pdf_content, filetype="pdf")
-            num_pages = min(len(pdf), MAX_PAGES)
+            total_pages = len(pdf)
+            pdf.close()
             
-            if len(pdf) > MAX_PAGES:
-                logger.warning(f"[PDF] Truncating from {len(pdf)} to {MAX_PAGES} pages")
+            num_pages = min(total_pages, MAX_PAGES)
             
-            logger.info(f"[PDF] Processing {num_pages} pages")
+            if total_pages > MAX_PAGES:
+                logger.warning(f"[PDF] Truncating from {total_pages} to {MAX_PAGES} pages")
             
-            # Initialize PDF converter
-            converter = PDFPageConverter(zoom=2.0, max_dim=1600)
+            logger.info(f"[PDF] Processing {num_pages} pages")
             
-            # Convert all pages to images first
-            page_data = []
-            for page_num in range(num_pages):
-                if self._check_timeout("conversion"):
-                    logger.warning(f"[PDF] Timeout during conversion at page {page_num + 1}")
-                    break
-                
-                pdf_page = pdf[page_num]
-                img, text = converter.convert_page(pdf_page, page_num + 1)
-                page_data.append({
-                    'page_num': page_num + 1,
-                    'image': img,
-                    'text': text,
-                    'is_digital': len(text) > 100
-                })
-                
-                logger.debug(f"[PDF] Page {page_num + 1}: {img.size[0]}x{img.size[1]}, "
-                           f"text: {len(text)} chars")
+            # Use parallel processing for larger PDFs, sequential for small ones
+            extract_batch = (self._extract_pages_parallel if num_pages >= 4
+                             else self._extract_pages_sequential)
             
-            pdf.close()
-            timings['conversion'] = time.time() - t0
-            logger.info(f"[PDF] Conversion completed in {timings['conversion']:.1f}s")
+            timings['conversion'] = 0.0
+            timings['extraction'] = 0.0
+            results = []
+            fast_path_pages = 0
             
-            # Extract from pages (parallel or sequential based on count)
+            # Rendering happens as each batch is pulled from the generator
             t0 = time.time()
+            for batch in self._iter_page_batches(pdf_content, num_pages):
+                timings['conversion'] += time.time() - t0
+                
+                t0 = time.time()
+                
+                # Digital pages with a recognizable table layout skip Gemini
+                llm_pages = []
+                for data in batch:
+                    result = self._try_text_fast_path(data)
+                    if result:
+                        results.append(result)
+                        fast_path_pages += 1
+                    else:
+                        llm_pages.append(data)
+                
+                if llm_pages:
+                    results.extend(extract_batch(llm_pages))
+                timings['extraction'] += time.time() - t0
+                
+                t0 = time.time()
             
-            if num_pages >= 4:
-                # Use parallel processing for larger PDFs
-                results = self._extract_pages_parallel(page_data)
-            else:
-                # Sequential for small PDFs
-                results = self._extract_pages_sequential(page_data)
+            if fast_path_pages:
+                with self._token_lock:
+                    self.fast_path_hits += fast_path_pages
+                logger.info(f"[PDF] {fast_path_pages} pages extracted from text layer")
             
-            timings['extraction'] = time.time() - t0
+            logger.info(f"[PDF] Conversion completed in {timings['conversion']:.1f}s")
             
             # Aggregate results
             all_pages = []
             total_items = 0
             
-            for page_result in results:
+            for page_result in sorted(results, key=lambda r: int(r['page_no'])):
                 if page_result and page_result.get('bill_items'):
                     all_pages.append(page_result)
                     total_items += len(page_result['bill_items'])
@@ -270,70 +599,206 @@ class InvoiceExtractor:
             logger.error(f"[ERROR] PDF processing failed: {str(e)}")
             raise
     
-    def _extract_pages_parallel(self, page_data: List[dict]) -> List[dict]:
-        """Extract from pages in parallel."""
-        results = [None] * len(page_data)
+    def _iter_page_batches(self, pdf_content: bytes,
+                           num_pages: int) -> Iterator[List[dict]]:
+        """
+        Lazily render PDF pages to images, one batch at a time.
         
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = {}
+        Each batch of PAGE_BATCH_SIZE pages is split across the render
+        worker processes. The next batch is submitted before the current
+        one is yielded, so rendering overlaps with Gemini calls on the
+        current batch while at most two batches are held in memory.
+        
+        The PDF is copied into shared memory once per document; render
+        tasks only carry its name, instead of pickling the whole file to
+        a worker for every chunk of every batch.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=len(pdf_content))
+        try:
+            shm.buf[:len(pdf_content)] = pdf_content
+            pdf_ref = (shm.name, len(pdf_content))
             
-            for i, data in enumerate(page_data):
-                if self._check_timeout("parallel_submit"):
-                    break
-                
-                future = executor.submit(
-                    self._extract_single_page,
-                    data['image'],
-                    data['page_num'],
-                    data['text'] if data['is_digital'] else None
-                )
-                futures[future] = i
-                time.sleep(API_DELAY)  # Stagger API calls
+            page_batches = self._batched(range(1, num_pages + 1), PAGE_BATCH_SIZE)
             
-            for future in futures:
-                idx = futures[future]
-                try:
-                    result = future.result(timeout=PAGE_TIMEOUT)
-                    results[idx] = result
-                    
-                    if result and result.get('bill_items'):
-                        logger.info(f"[PAGE {page_data[idx]['page_num']}] "
-                                   f"Extracted {len(result['bill_items'])} items")
+            page_nums = next(page_batches, None)
+            futures = self._submit_render(pdf_ref, page_nums) if page_nums else None
+            
+            while futures:
+                rendered = sorted(
+                    (page for future in futures for page in future.result()),
+                    key=lambda page: page[0]
+                )
+                
+                # Prefetch the next batch while the caller extracts this one
+                page_nums = next(page_batches, None)
+                futures = None
+                if page_nums:
+                    if self._check_cancelled("conversion") or self._check_timeout("conversion"):
+                        logger.warning(f"[PDF] Stopping conversion at page {page_nums[0]}")
                     else:
-                        logger.info(f"[PAGE {page_data[idx]['page_num']}] No items found")
-                        
-                except FuturesTimeoutError:
-                    logger.warning(f"[PAGE {page_data[idx]['page_num']}] "
-                                  f"Timeout after {PAGE_TIMEOUT}s")
-                except Exception as e:
-                    logger.error(f"[PAGE {page_data[idx]['page_num']}] Error: {str(e)}")
+                        futures = self._submit_render(pdf_ref, page_nums)
+                
+                batch = []
+                for page_num, blob, text in rendered:
+                    logger.debug(f"[PDF] Page {page_num}: {len(blob['data'])/1024:.1f}KB JPEG, "
+                               f"text: {len(text)} chars")
+                    batch.append({
+                        'page_num': page_num,
+                        'image': blob,
+                        'text': text,
+                        'is_digital': len(text) > 100
+                    })
+                
+                try:
+                    yield batch
+                except GeneratorExit:
+                    for future in futures or ():
+                        future.cancel()
+                    raise
+        finally:
+            shm.close()
+            shm.unlink()
+    
+    def _submit_render(self, pdf_ref: Tuple[str, int], page_nums: List[int]) -> list:
+        """Split pages across the render workers and submit them."""
+        chunks = [page_nums[i::RENDER_WORKERS]
+                  for i in range(min(RENDER_WORKERS, len(page_nums)))]
+        return [
+            _RENDER_EXECUTOR.submit(render_shared_pdf_pages, *pdf_ref, chunk, 2.0, 1600)
+            for chunk in chunks
+        ]
+    
+    @staticmethod
+    def _batched(items: Iterable, size: int) -> Iterator[list]:
+        """Chunk an iterable into lists of at most `size` items."""
+        iterator = iter(items)
+        while True:
+            batch = list(islice(iterator, size))
+            if not batch:
+                return
+            yield batch
+    
+    def _try_text_fast_path(self, data: dict) -> Optional[Dict]:
+        """Extract a digital page from its text layer, or None to use Gemini."""
+        if not data['is_digital']:
+            return None
+        
+        result = self.text_extractor.try_extract(data['text'])
+        if not result:
+            return None
         
-        return [r for r in results if r is not None]
+        result['page_no'] = str(data['page_num'])
+        self._log_page_result(data['page_num'], result)
+        return result
     
-    def _extract_pages_sequential(self, page_data: List[dict]) -> List[dict]:
-        """Extract from pages sequentially."""
-        results = []
+    def _group_pages(self, page_data: List[dict]) -> List[List[dict]]:
+        """
+        Split pages into groups that share a single Gemini call.
+        
+        Groups hold up to BATCH_PAGES pages and are closed early once the
+        combined text layer would exceed BATCH_TEXT_BUDGET characters, so
+        text-heavy pages get smaller groups.
+        """
+        groups = []
+        current = []
+        text_chars = 0
         
         for data in page_data:
-            if self._check_timeout("sequential"):
+            page_chars = min(len(data['text']), BATCH_PAGE_TEXT_CHARS) if data['is_digital'] else 0
+            if current and (len(current) >= BATCH_PAGES or
+                            text_chars + page_chars > BATCH_TEXT_BUDGET):
+                groups.append(current)
+                current = []
+                text_chars = 0
+            current.append(data)
+            text_chars += page_chars
+        
+        if current:
+            groups.append(current)
+        return groups
+    
+    def _log_page_result(self, page_num: int, result: Optional[Dict]):
+        """Log the outcome of a single page extraction."""
+        if result and result.get('bill_items'):
+            logger.info(f"[PAGE {page_num}] Extracted {len(result['bill_items'])} items")
+        else:
+            logger.info(f"[PAGE {page_num}] No items found")
+    
+    def _extract_pages_parallel(self, page_data: List[dict]) -> List[dict]:
+        """Extract from page groups in parallel."""
+        groups = self._group_pages(page_data)
+        results = [None] * len(groups)
+        
+        logger.info(f"[PDF] Page executor queue depth: {_PAGE_EXECUTOR._work_queue.qsize()}")
+        
+        futures = {}
+        for i, group in enumerate(groups):
+            if self._check_cancelled("parallel_submit") or self._check_timeout("parallel_submit"):
                 break
             
-            result = self._extract_single_page(
-                data['image'],
-                data['page_num'],
-                data['text'] if data['is_digital'] else None
+            # Each task gets its own context copy (a context can only be
+            # entered by one thread at a time)
+            future = _PAGE_EXECUTOR.submit(
+                contextvars.copy_context().run, self._extract_page_group, group
             )
+            futures[future] = i
+        
+        for future in futures:
+            idx = futures[future]
+            first_page = groups[idx][0]['page_num']
+            try:
+                results[idx] = future.result(timeout=PAGE_TIMEOUT * len(groups[idx]))
+            except FuturesTimeoutError:
+                logger.warning(f"[PAGE {first_page}] "
+                              f"Timeout after {PAGE_TIMEOUT * len(groups[idx])}s")
+            except Exception as e:
+                logger.error(f"[PAGE {first_page}] Error: {str(e)}")
+        
+        return [page for group in results if group for page in group]
+    
+    def _extract_pages_sequential(self, page_data: List[dict]) -> List[dict]:
+        """Extract from page groups sequentially."""
+        results = []
+        
+        for group in self._group_pages(page_data):
+            if self._check_cancelled("sequential") or self._check_timeout("sequential"):
+                break
+            
+            results.extend(self._extract_page_group(group))
+        
+        return results
+    
+    def _extract_page_group(self, group: List[dict]) -> List[dict]:
+        """
+        Extract a group of pages with one batched call.
+        
+        Pages missing from (or cut off at the end of) the batched response
+        fall back to individual single-page extraction.
+        """
+        batch_results = {}
+        if len(group) > 1:
+            try:
+                batch_results = self._call_gemini_batch(group)
+            except Exception as e:
+                logger.warning(f"[PAGE {group[0]['page_num']}-{group[-1]['page_num']}] "
+                              f"Batch call failed: {str(e)}")
+        
+        results = []
+        for data in group:
+            result = batch_results.get(data['page_num'])
+            if result is None:
+                if len(group) > 1:
+                    logger.info(f"[PAGE {data['page_num']}] Not in batch response, "
+                               f"extracting individually")
+                result = self._extract_single_page(
+                    data['image'],
+                    data['page_num'],
+                    data['text'] if data['is_digital'] else None
+                )
             
             if result:
                 results.append(result)
-                
-                if result.get('bill_items'):
-                    logger.info(f"[PAGE {data['page_num']}] "
-                               f"Extracted {len(result['bill_items'])} items")
-                else:
-                    logger.info(f"[PAGE {data['page_num']}] No items found")
-            
-            time.sleep(API_DELAY)
+            self._log_page_result(data['page_num'], result)
         
         return results
     
@@ -342,16 +807,26 @@ class InvoiceExtractor:
         try:
             t0 = time.time()
             
-            # Load and preprocess image
+            # Image.open only reads the header; pixels are decoded on demand
             img = Image.open(BytesIO(image_content))
-            img = self.preprocessor.process(img, page_num=1)
+            logger.info(f"[IMAGE] Size: {img.size[0]}x{img.size[1]}")
+            
+            if image_content[:3] == JPEG_MAGIC and self.preprocessor.is_upload_ready(img):
+                # Already a suitable JPEG - skip the decode/re-encode round-trip
+                logger.info("[IMAGE] Sending original JPEG bytes")
+                image = {"mime_type": "image/jpeg", "data": image_content}
+            else:
+                # Preprocess in a worker process; the result is encoded once
+                # so retries resend the same bytes
+                image = _RENDER_EXECUTOR.submit(
+                    preprocess_image_bytes, image_content, self.preprocessor.target_max_dim
+                ).result()
             
             timings['conversion'] = time.time() - t0
-            logger.info(f"[IMAGE] Size: {img.size[0]}x{img.size[1]}")
             
             # Extract
             t0 = time.time()
-            result = self._extract_single_page(img, 1, None)
+            result = self._extract_single_page(image, 1, None)
             timings['extraction'] = time.time() - t0
             
             items_count = len(result.get('bill_items', [])) if result else 0
@@ -365,13 +840,13 @@ class InvoiceExtractor:
             logger.error(f"[ERROR] Image processing failed: {str(e)}")
             raise
     
-    def _extract_single_page(self, image: Image.Image, page_num: int,
+    def _extract_single_page(self, image: dict, page_num: int,
                              page_text: Optional[str] = None) -> Optional[Dict]:
         """
         Extract from a single page with retry logic.
         
         Args:
-            image: Preprocessed PIL Image
+            image: Encoded {"mime_type", "data"} image blob, reused across retries
             page_num: Page number (1-indexed)
             page_text: Extracted text for digital PDFs
             
@@ -384,53 +859,88 @@ class InvoiceExtractor:
             "bill_items": []
         }
         
+        best_result = None
+        max_output_tokens = None  # Default budget from the generation config
+        
         for attempt in range(1, MAX_RETRIES + 1):
+            if attempt > 1 and self._check_cancelled(f"page {page_num} retry"):
+                break
+            
             try:
-                result = self._call_gemini(image, page_num, page_text, attempt)
+                result, truncated = self._call_gemini(
+                    image, page_num, page_text, attempt, max_output_tokens
+                )
                 
                 if result and result.get('bill_items'):
                     result['page_no'] = str(page_num)
-                    return result
+                    if not truncated:
+                        return result
+                    best_result = result  # Keep salvaged items if the retry fails
+                elif result is not None and not truncated:
+                    # Model finished normally and found nothing - retrying won't help
+                    logger.debug(f"[PAGE {page_num}] No items on page, skipping retry")
+                    return empty_result
+                
+                if truncated:
+                    logger.info(f"[PAGE {page_num}] Response hit max_output_tokens, "
+                               f"retrying with {MAX_OUTPUT_TOKENS}")
+                    max_output_tokens = MAX_OUTPUT_TOKENS
                 
-                # If no items and not last attempt, retry
+                # Truncated or unparseable response, retry if attempts remain
                 if attempt < MAX_RETRIES:
-                    logger.debug(f"[PAGE {page_num}] Attempt {attempt}: No items, retrying...")
-                    time.sleep(1.0)
+                    logger.debug(f"[PAGE {page_num}] Attempt {attempt}: Incomplete, retrying...")
                     
             except Exception as e:
                 logger.warning(f"[PAGE {page_num}] Attempt {attempt} error: {str(e)}")
                 if attempt < MAX_RETRIES:
-                    time.sleep(2.0)
+                    # Jittered backoff so parallel pages don't retry in lockstep
+                    time.sleep(RETRY_BACKOFF * attempt * random.uniform(0.5, 1.5))
         
-        return empty_result
+        return best_result or empty_result
     
-    def _call_gemini(self, image: Image.Image, page_num: int,
-                     page_text: Optional[str], attempt: int) -> Optional[Dict]:
+    def _call_gemini(self, image: dict, page_num: int,
+                     page_text: Optional[str], attempt: int,
+                     max_output_tokens: Optional[int] = None) -> Tuple[Optional[Dict], bool]:
         """
         Make a single Gemini API call with parsing.
         
         Args:
-            image: PIL Image
+            image: Encoded {"mime_type", "data"} image blob
             page_num: Page number
             page_text: Optional text context
             attempt: Attempt number (1, 2, ...)
+            max_output_tokens: Override for the config's output token budget
             
         Returns:
-            Parsed and validated result dict
+            Tuple of (parsed and validated result dict or None,
+            whether the response was cut off at max_output_tokens)
         """
         try:
-            # Select appropriate prompt
-            prompt = select_prompt(page_text or "", attempt)
+            # Select appropriate prompt, specialized by page type when clear
+            detected_type = classify_page_text(page_text) if page_text else None
+            if detected_type and attempt == 1:
+                logger.debug(f"[PAGE {page_num}] Using {detected_type} prompt")
+            prompt, prompt_suffix = select_prompt(page_text or "", attempt, detected_type)
             
             # Select generation config
-            gen_config = GENERATION_CONFIG if attempt == 1 else RETRY_GENERATION_CONFIG
+            gen_config = select_config(attempt)
+            if max_output_tokens:
+                gen_config['max_output_tokens'] = max_output_tokens
+            
+            # Identical page image under the same prompt: reuse the answer
+            cache_key = None
+            if _PAGE_CACHE.enabled:
+                cache_key = _PAGE_CACHE.key(prompt_fingerprint(prompt, prompt_suffix), image)
+                cached = _PAGE_CACHE.get(cache_key)
+                if cached is not None:
+                    logger.info(f"[PAGE {page_num}] Page cache hit")
+                    return cached, False
+            
+            # Shared instructions lead so repeated calls share a cacheable prefix
+            contents = [prompt, prompt_suffix, image] if prompt_suffix else [prompt, image]
             
             # Make API call
-            response = self.model.generate_content(
-                [prompt, image],
-                generation_config=genai.types.GenerationConfig(**gen_config),
-                safety_settings=self.safety_settings
-            )
+            response = self._generate(contents, gen_config)
             
             # Track tokens
             if hasattr(response, 'usage_metadata'):
@@ -444,65 +954,149 @@ class InvoiceExtractor:
             # Extract response text
             text = self._get_response_text(response)
             if not text:
-                logger.warning(f"[PAGE {page_num}] Empty response from Gemini")
-                return None
+                # Thinking can use up the budget before any text is written;
+                # report that as truncation so the retry gets a larger one
+                truncated = self._is_truncated(response)
+                logger.warning(f"[PAGE {page_num}] Empty response from Gemini"
+                              f"{' (truncated)' if truncated else ''}")
+                return None, truncated
             
-            logger.debug(f"[PAGE {page_num}] Response length: {len(text)} chars")
+            truncated = self._is_truncated(response)
+            logger.debug(f"[PAGE {page_num}] Response length: {len(text)} chars"
+                        f"{' (truncated)' if truncated else ''}")
             
             # Parse JSON
             parsed = self.parser.parse(text, page_num)
             if not parsed:
                 logger.warning(f"[PAGE {page_num}] JSON parsing failed")
-                return None
+                return None, truncated
             
             # Validate and clean
             validated = self.validator.validate_and_clean(parsed, page_num)
             
-            return validated
+            # Only complete, non-empty answers are worth replaying
+            if cache_key and not truncated and validated['bill_items']:
+                _PAGE_CACHE.put(cache_key, validated)
+            
+            return validated, truncated
             
         except Exception as e:
             logger.error(f"[PAGE {page_num}] Gemini call failed: {str(e)}")
             raise
     
+    def _call_gemini_batch(self, group: List[dict]) -> Dict[int, Dict]:
+        """
+        Extract several pages with a single Gemini call.
+        
+        All page images share one copy of the instruction prompt. Each image
+        is preceded by a "PAGE n:" marker (and the page's text layer for
+        digital pages), and the model answers with one entry per page.
+        
+        Args:
+            group: Page data dicts to extract together
+            
+        Returns:
+            Dict mapping page number to validated page result. Pages that
+            could not be recovered from the response are omitted.
+        """
+        page_nums = [data['page_num'] for data in group]
+        
+        contents = [get_batch_prompt(page_nums)]
+        for data in group:
+            contents.append(f"PAGE {data['page_num']}:")
+            contents.append(data['image'])
+            if data['is_digital']:
+                contents.append(f"PAGE {data['page_num']} TEXT:\n"
+                                f"{data['text'][:BATCH_PAGE_TEXT_CHARS]}")
+        
+        gen_config = dict(GENERATION_CONFIG)
+        gen_config['max_output_tokens'] = min(
+            MAX_OUTPUT_TOKENS, GENERATION_CONFIG['max_output_tokens'] * len(group)
+        )
+        # Batched output nests pages, so it needs its own schema
+        gen_config['response_schema'] = BATCH_RESPONSE_SCHEMA
+        
+        response = self._generate(contents, gen_config)
+        
+        # Track tokens
+        if hasattr(response, 'usage_metadata'):
+            self._add_tokens(
+                getattr(response.usage_metadata, 'prompt_token_count', 0),
+                getattr(response.usage_metadata, 'candidates_token_count', 0)
+            )
+        else:
+            self._add_tokens(500 * len(group), 200 * len(group))  # Estimate
+        
+        text = self._get_response_text(response)
+        if not text:
+            logger.warning(f"[PAGE {page_nums[0]}-{page_nums[-1]}] Empty batch response")
+            return {}
+        
+        pages = self.parser.parse_pages(text, page_nums[0])
+        if not pages:
+            return {}
+        
+        # A truncated response may have cut the last page short
+        if self._is_truncated(response):
+            pages = pages[:-1]
+        
+        results = {}
+        for page in pages:
+            try:
+                page_num = int(str(page.get('page_no', '')).strip())
+            except ValueError:
+                continue
+            if page_num not in page_nums or page_num in results:
+                continue
+            
+            validated = self.validator.validate_and_clean(page, page_num)
+            validated['page_no'] = str(page_num)
+            results[page_num] = validated
+        
+        logger.debug(f"[PAGE {page_nums[0]}-{page_nums[-1]}] Batch returned "
+                    f"{len(results)}/{len(page_nums)} pages")
+        return results
+    
+    def _is_truncated(self, response) -> bool:
+        """Check if generation stopped at the output token limit."""
+        try:
+            reason = response.candidates[0].finish_reason
+        except (AttributeError, IndexError, TypeError):
+            return False
+        return getattr(reason, 'value', reason) == 2  # MAX_TOKENS
+    
     def _get_response_text(self, response) -> Optional[str]:
         """Safely extract text from Gemini response."""
         try:
-            if not response:
-                return None
-            
-            if not hasattr(response, 'candidates') or not response.candidates:
-                # Check for blocking
-                if hasattr(response, 'prompt_feedback'):
-                    feedback = response.prompt_feedback
-                    if hasattr(feedback, 'block_reason'):
-                        logger.warning(f"Response blocked: {feedback.block_reason}")
-                return None
-            
             candidate = response.candidates[0]
             
             # Check finish reason
-            if hasattr(candidate, 'finish_reason'):
-                reason = candidate.finish_reason
-                reason_val = getattr(reason, 'value', reason)
-                if reason_val in [3, 4]:  # SAFETY, RECITATION
-                    logger.warning(f"Response blocked with reason: {reason_val}")
-                    return None
-            
-            # Extract text
-            if not hasattr(candidate, 'content') or not candidate.content:
-                return None
-            
-            if not hasattr(candidate.content, 'parts') or not candidate.content.parts:
+            reason = candidate.finish_reason
+            reason_val = getattr(reason, 'value', reason)
+            if reason_val in (3, 4):  # SAFETY, RECITATION
+                logger.warning(f"Response blocked with reason: {reason_val}")
                 return None
             
             text = candidate.content.parts[0].text
             return text.strip() if text else None
             
+        except (AttributeError, IndexError, TypeError):
+            # No candidates or content; report a prompt-level block if present
+            block_reason = getattr(getattr(response, 'prompt_feedback', None),
+                                   'block_reason', None)
+            if block_reason:
+                logger.warning(f"Response blocked: {block_reason}")
+            return None
         except Exception as e:
             logger.error(f"Error extracting response text: {str(e)}")
             return None
 
 
+def close_http_client():
+    """Close pooled download connections (call on application shutdown)."""
+    _HTTP_CLIENT.close()
+
+
 # Convenience function for direct usage
 def extract_invoice(api_key: str, url: str) -> Dict:
     """
@@ -516,4 +1110,5 @@ def extract_invoice(api_key: str, url: str) -> Dict:
         Extraction results
     """
     extractor = InvoiceExtractor(api_key)
-    return extractor.extract_from_url(url)
\ No newline at end of file
+    result, _ = extractor.extract_from_url(url)
+    return result
\ No newline at end of file
@@ -12,17 +12,22 @@ Features:
 import asyncio
 import logging
 import os
+import random
 import sys
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Optional
+from typing import List, Literal, Optional, Tuple
 
+import httpx
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, HttpUrl, Field
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, HttpUrl, Field
 
-from invoice_extractor import InvoiceExtractor
+from invoice_extractor import InvoiceExtractor, close_http_client
 
 # ============== Logging Configuration ==============
 
@@ -44,6 +49,16 @@ logger = logging.getLogger(__name__)
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 REQUEST_TIMEOUT = 150  # seconds - hard timeout for API requests
+DISCONNECT_POLL_INTERVAL = 1.0  # seconds between client disconnect checks
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", 2))  # Concurrent extractions per process
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))  # uvicorn worker processes
+ENABLE_CORS = os.getenv("ENABLE_CORS", "1") == "1"
+PRECHECK_TIMEOUT = 5.0  # seconds for the HEAD check before queueing a request
+WARMUP_TIMEOUT = 10.0  # seconds startup waits for the Gemini warm-up call
+MAX_DOCUMENT_MB = int(os.getenv("MAX_DOCUMENT_MB", 50))
+ACCESS_LOG = os.getenv("ACCESS_LOG", "0") == "1"  # Per-request uvicorn access lines
+TRACEBACK_SAMPLE_RATE = float(os.getenv("TRACEBACK_SAMPLE_RATE", 0.05))  # Share of failures logged with traceback
+DEBUG_LAST_RESPONSE = os.getenv("DEBUG_LAST_RESPONSE", "0") == "1"  # Keep last response for /last-response
 VERSION = "4.0.0"
 
 if not GEMINI_API_KEY:
@@ -59,34 +74,57 @@ app = FastAPI(
     description="Extract line items from medical bills using Gemini Vision",
     version=VERSION,
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse
 )
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS middleware - only needed for browser clients; server-to-server
+# deployments can set ENABLE_CORS=0 to skip it on every request
+if ENABLE_CORS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+# Compress larger JSON responses (many bill items); small ones are sent as-is
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Thread pool for extraction (per worker process). Rendering and
+# preprocessing run in the extractor's own process pool, so these threads
+# mostly wait on network I/O.
+executor = ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS)
 
-# Thread pool for extraction
-executor = ThreadPoolExecutor(max_workers=2)
+# Async client for cheap HEAD checks on the event loop
+precheck_client = httpx.AsyncClient(timeout=PRECHECK_TIMEOUT, follow_redirects=True)
 
-# Global state
+# Global state (per worker process)
 _extractor: Optional[InvoiceExtractor] = None
 _last_response: Optional[dict] = None
 
 # ============== Request/Response Models ==============
 
+# Page types returned by ResponseValidator (free-form types are normalized)
+PageTypeName = Literal[
+    "Bill Detail", "Pharmacy", "Final Bill", "Investigation",
+    "Consultation", "Room Charges", "Services"
+]
+
+# Closed, immutable models; unknown fields are dropped rather than stored
+MODEL_CONFIG = ConfigDict(extra="ignore", frozen=True)
+
+
 class ExtractionRequest(BaseModel):
     """Request model for extraction endpoint."""
+    model_config = MODEL_CONFIG
     document: HttpUrl = Field(..., description="URL to PDF or image document")
 
 
 class BillItem(BaseModel):
     """Single line item from invoice."""
+    model_config = MODEL_CONFIG
     item_name: str = Field(..., description="Item/service description")
     item_amount: float = Field(..., ge=0, description="Net amount")
     item_rate: Optional[float] = Field(None, ge=0, description="Unit rate")
@@ -95,13 +133,15 @@ class BillItem(BaseModel):
 
 class PageLineItems(BaseModel):
     """Extraction results for a single page."""
+    model_config = MODEL_CONFIG
     page_no: str = Field(..., description="Page number")
-    page_type: str = Field(..., description="Type of page content")
+    page_type: PageTypeName = Field(..., description="Type of page content")
     bill_items: List[BillItem] = Field(default_factory=list)
 
 
 class TokenUsage(BaseModel):
     """Token usage statistics."""
+    model_config = MODEL_CONFIG
     total_tokens: int = Field(default=0)
     input_tokens: int = Field(default=0)
     output_tokens: int = Field(default=0)
@@ -109,16 +149,19 @@ class TokenUsage(BaseModel):
 
 class ExtractionData(BaseModel):
     """Extracted data container."""
+    model_config = MODEL_CONFIG
     pagewise_line_items: List[PageLineItems] = Field(default_factory=list)
     total_item_count: int = Field(default=0, ge=0)
 
 
 class ExtractionResponse(BaseModel):
     """Response model for extraction endpoint."""
+    model_config = MODEL_CONFIG
     is_success: bool = Field(..., description="Whether extraction succeeded")
     token_usage: TokenUsage = Field(default_factory=TokenUsage)
     data: Optional[ExtractionData] = Field(None, description="Extracted data")
     error: Optional[str] = Field(None, description="Error message if failed")
+    cache_hit: bool = Field(default=False, description="Whether the result was served from cache")
 
 
 # ============== Helper Functions ==============
@@ -139,45 +182,139 @@ def get_extractor() -> InvoiceExtractor:
     return _extractor
 
 
-def run_extraction(url: str) -> dict:
-    """Run extraction in thread pool."""
-    extractor = get_extractor()
-    return extractor.extract_from_url(url)
+def run_extraction(extractor: InvoiceExtractor, url: str,
+                   cancel_event: Optional[threading.Event] = None) -> Tuple[dict, dict]:
+    """Run extraction in thread pool; returns (result, token usage)."""
+    return extractor.extract_from_url(url, cancel_event)
 
 
-def build_response(result: dict, extractor: InvoiceExtractor) -> ExtractionResponse:
-    """Build response from extraction result."""
-    token_usage = extractor.get_token_usage()
+async def watch_disconnect(http_request: Request, cancel_event: threading.Event):
+    """Signal cancellation if the client goes away before extraction ends."""
+    while not cancel_event.is_set():
+        if await http_request.is_disconnected():
+            logger.warning("[CANCEL] Client disconnected, stopping extraction")
+            cancel_event.set()
+            return
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+
+async def precheck_document(url: str) -> Optional[str]:
+    """
+    HEAD the document before it takes an extraction worker.
     
+    Only definite failures are rejected. Many storage URLs (e.g. presigned
+    GET links) refuse HEAD, so errors and other statuses fall through to
+    the real download.
+    
+    Returns:
+        Error message if the document clearly cannot be processed, else None
+    """
+    try:
+        response = await precheck_client.head(url)
+    except httpx.HTTPError:
+        return None
+    
+    if response.status_code in (404, 410):
+        return f"Document not found (HTTP {response.status_code})"
+    
+    length = response.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > MAX_DOCUMENT_MB * 1024 * 1024:
+        return f"Document too large ({int(length) / 1024 / 1024:.1f}MB > {MAX_DOCUMENT_MB}MB)"
+    
+    return None
+
+
+def build_response(result: dict, token_usage: dict) -> dict:
+    """
+    Build response from extraction result.
+    
+    Items were already cleaned by ResponseValidator, so the response is
+    assembled as a plain dict matching ExtractionResponse instead of
+    re-validating every item through Pydantic.
+    """
     pagewise_items = []
     for page in result.get("pagewise_line_items", []):
-        items = []
-        for item in page.get("bill_items", []):
-            items.append(BillItem(
-                item_name=item.get("item_name", ""),
-                item_amount=float(item.get("item_amount", 0)),
-                item_rate=float(item["item_rate"]) if item.get("item_rate") else None,
-                item_quantity=float(item["item_quantity"]) if item.get("item_quantity") else None
-            ))
+        # ResponseValidator emits float amounts and only includes rate and
+        # quantity when positive, so no per-field coercion is needed here
+        items = [
+            {
+                "item_name": item.get("item_name", ""),
+                "item_amount": item.get("item_amount", 0.0),
+                "item_rate": item.get("item_rate"),
+                "item_quantity": item.get("item_quantity")
+            }
+            for item in page.get("bill_items", [])
+        ]
         
-        pagewise_items.append(PageLineItems(
-            page_no=str(page.get("page_no", "1")),
-            page_type=page.get("page_type", "Bill Detail"),
-            bill_items=items
-        ))
+        pagewise_items.append({
+            "page_no": str(page.get("page_no", "1")),
+            "page_type": page.get("page_type", "Bill Detail"),
+            "bill_items": items
+        })
+    
+    return {
+        "is_success": True,
+        "token_usage": {
+            "total_tokens": token_usage["total_tokens"],
+            "input_tokens": token_usage["input_tokens"],
+            "output_tokens": token_usage["output_tokens"]
+        },
+        "data": {
+            "pagewise_line_items": pagewise_items,
+            "total_item_count": result.get("total_item_count", 0)
+        },
+        "error": None,
+        "cache_hit": result.get("cache_hit", False)
+    }
+
+
+def build_error_response(error: str) -> dict:
+    """Build a failed extraction response (same shape as ExtractionResponse)."""
+    return {
+        "is_success": False,
+        "token_usage": {"total_tokens": 0, "input_tokens": 0, "output_tokens": 0},
+        "data": None,
+        "error": error,
+        "cache_hit": False
+    }
+
+
+def remember_response(response: dict):
+    """Keep the response for /last-response when debugging is enabled."""
+    global _last_response
+    if DEBUG_LAST_RESPONSE:
+        _last_response = response
+
+
+# ============== Lifecycle Events ==============
+
+@app.on_event("startup")
+async def preload_extractor():
+    """Create the extractor and warm the Gemini connection before serving."""
+    if not GEMINI_API_KEY:
+        return
     
-    return ExtractionResponse(
-        is_success=True,
-        token_usage=TokenUsage(
-            total_tokens=token_usage["total_tokens"],
-            input_tokens=token_usage["input_tokens"],
-            output_tokens=token_usage["output_tokens"]
-        ),
-        data=ExtractionData(
-            pagewise_line_items=pagewise_items,
-            total_item_count=result.get("total_item_count", 0)
+    loop = asyncio.get_running_loop()
+    try:
+        extractor = get_extractor()
+        # Default executor, so a hung call can't hold an extraction slot
+        warmup_time = await asyncio.wait_for(
+            loop.run_in_executor(None, extractor.warm_up),
+            timeout=WARMUP_TIMEOUT
         )
-    )
+        logger.info(f"[STARTUP] Gemini warm-up completed in {warmup_time:.1f}s")
+    except asyncio.TimeoutError:
+        logger.warning(f"[STARTUP] Gemini warm-up timed out after {WARMUP_TIMEOUT}s")
+    except Exception as e:
+        # Not fatal - the first request will retry the connection
+        logger.warning(f"[STARTUP] Gemini warm-up failed: {str(e)}")
+
+
+@app.on_event("shutdown")
+async def close_connections():
+    """Release pooled download and pre-check connections."""
+    close_http_client()
+    await precheck_client.aclose()
 
 
 # ============== API Endpoints ==============
@@ -214,13 +351,15 @@ async def health_check():
 @app.get("/last-response")
 async def get_last_response():
     """Get last extraction response for debugging."""
+    if not DEBUG_LAST_RESPONSE:
+        return {"message": "Last response capture disabled (set DEBUG_LAST_RESPONSE=1 to enable)"}
     if _last_response:
         return _last_response
     return {"message": "No extraction performed yet"}
 
 
-@app.post("/extract-bill-data", response_model=ExtractionResponse)
-async def extract_bill_data(request: ExtractionRequest):
+@app.post("/extract-bill-data", responses={200: {"model": ExtractionResponse}})
+async def extract_bill_data(request: ExtractionRequest, http_request: Request):
     """
     Extract line items from medical invoice.
     
@@ -230,35 +369,47 @@ async def extract_bill_data(request: ExtractionRequest):
     
     Returns extracted line items organized by page.
     """
-    global _last_response
-    
     start_time = time.time()
     document_url = str(request.document)
     
-    logger.info("=" * 70)
-    logger.info(f"[REQUEST] New extraction request")
-    logger.info(f"[REQUEST] URL: {document_url[:100]}{'...' if len(document_url) > 100 else ''}")
+    logger.info(f"[REQUEST] New extraction request: "
+               f"{document_url[:100]}{'...' if len(document_url) > 100 else ''}")
     
     try:
-        # Run extraction with timeout
-        loop = asyncio.get_event_loop()
+        extractor = get_extractor()
+        
+        # Reject dead or oversized documents without using a worker slot.
+        # Cached URLs skip the HEAD round trip since they won't be downloaded.
+        precheck_error = None
+        if not extractor.has_cached_result(document_url):
+            precheck_error = await precheck_document(document_url)
+        if precheck_error:
+            logger.warning(f"[REJECTED] {precheck_error}")
+            error_response = build_error_response(precheck_error)
+            remember_response(error_response)
+            return ORJSONResponse(error_response)
+        
+        # Run extraction with timeout. The worker thread cannot be
+        # interrupted, so it is told to stop via cancel_event instead.
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+        watcher = asyncio.ensure_future(watch_disconnect(http_request, cancel_event))
         
         try:
-            result = await asyncio.wait_for(
-                loop.run_in_executor(executor, run_extraction, document_url),
+            result, token_usage = await asyncio.wait_for(
+                loop.run_in_executor(executor, run_extraction, extractor, document_url, cancel_event),
                 timeout=REQUEST_TIMEOUT
             )
         except asyncio.TimeoutError:
+            cancel_event.set()
             elapsed = time.time() - start_time
             logger.error(f"[TIMEOUT] Request exceeded {REQUEST_TIMEOUT}s (actual: {elapsed:.1f}s)")
             
-            error_response = ExtractionResponse(
-                is_success=False,
-                token_usage=TokenUsage(),
-                error=f"Request timeout after {REQUEST_TIMEOUT}s"
-            )
-            _last_response = error_response.model_dump()
-            return error_response
+            error_response = build_error_response(f"Request timeout after {REQUEST_TIMEOUT}s")
+            remember_response(error_response)
+            return ORJSONResponse(error_response)
+        finally:
+            watcher.cancel()
         
         elapsed = time.time() - start_time
         
@@ -266,19 +417,17 @@ async def extract_bill_data(request: ExtractionRequest):
             raise Exception("Extraction returned empty result")
         
         # Build response
-        extractor = get_extractor()
-        response = build_response(result, extractor)
+        response = build_response(result, token_usage)
         
         # Store for debugging
-        _last_response = response.model_dump()
+        remember_response(response)
         
         total_items = result.get("total_item_count", 0)
         num_pages = len(result.get("pagewise_line_items", []))
         
         logger.info(f"[SUCCESS] Extracted {total_items} items from {num_pages} pages in {elapsed:.1f}s")
-        logger.info("=" * 70)
         
-        return response
+        return ORJSONResponse(response)
         
     except HTTPException:
         raise
@@ -286,18 +435,15 @@ async def extract_bill_data(request: ExtractionRequest):
         elapsed = time.time() - start_time
         error_msg = str(e)
         
-        logger.error(f"[FAILED] {error_msg} (after {elapsed:.1f}s)")
-        logger.exception("Full traceback:")
-        logger.info("=" * 70)
+        logger.error(f"[FAILED] {type(e).__name__}: {error_msg} (after {elapsed:.1f}s)")
         
-        error_response = ExtractionResponse(
-            is_success=False,
-            token_usage=TokenUsage(),
-            error=error_msg
-        )
+        # Bursts of bad URLs would otherwise flood stdout with identical traces
+        if random.random() < TRACEBACK_SAMPLE_RATE:
+            logger.exception("Full traceback:")
         
-        _last_response = error_response.model_dump()
-        return error_response
+        error_response = build_error_response(error_msg)
+        remember_response(error_response)
+        return ORJSONResponse(error_response)
 
 
 # ============== Application Entry Point ==============
@@ -312,6 +458,7 @@ def main():
     logger.info(f"Host: {host}, Port: {port}")
     logger.info(f"API Key configured: {bool(GEMINI_API_KEY)}")
     logger.info(f"Request timeout: {REQUEST_TIMEOUT}s")
+    logger.info(f"Workers: {WEB_CONCURRENCY} process(es) x {EXTRACTION_WORKERS} extractions")
     logger.info("=" * 70)
     
     if not GEMINI_API_KEY:
@@ -326,8 +473,11 @@ def main():
         host=host,
         port=port,
         reload=False,
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
         log_level="info",
-        access_log=True
+        access_log=ACCESS_LOG
     )
 
 
@@ -9,6 +9,87 @@ from typing import Optional, List, Dict, Any, Tuple
 
 logger = logging.getLogger(__name__)
 
+# Prefer jiter, then orjson, for decoding LLM responses; fall back to the
+# stdlib parser. All raise ValueError subclasses on malformed input.
+try:
+    import jiter
+    
+    def _json_loads(text: str) -> Any:
+        # Item keys repeat on every row, so cache them during decode
+        return jiter.from_json(text.encode(), cache_mode="keys")
+except ImportError:
+    try:
+        import orjson
+        _json_loads = orjson.loads
+    except ImportError:
+        _json_loads = json.loads
+
+# Page types accepted verbatim from an explicit "page_type" field
+_EXPLICIT_PAGE_TYPES = frozenset([
+    'Pharmacy', 'Final Bill', 'Bill Detail',
+    'Investigation', 'Consultation', 'Room Charges', 'Services'
+])
+
+# Keywords used to infer a page type, checked in priority order
+_PAGE_TYPE_KEYWORDS = (
+    ('Pharmacy', ('pharmacy', 'medicine', 'tablet', 'capsule',
+                  'syrup', 'injection', 'mg', 'ml')),
+    ('Final Bill', ('final bill', 'grand total', 'total payable', 'net amount')),
+    ('Investigation', ('investigation', 'lab', 'test', 'pathology', 'radiology')),
+    ('Consultation', ('consultation', 'doctor', 'visit')),
+    ('Room Charges', ('room', 'bed', 'accommodation')),
+)
+
+
+# All keywords in one pattern, higher-priority types first. The lookahead
+# reports a match at every position, so keywords that overlap (e.g. "room"
+# and "mg" in "roomg") are both seen, just as with per-keyword substring tests.
+_PAGE_TYPE_PRIORITY = {
+    kw: priority
+    for priority, (_, keywords) in enumerate(_PAGE_TYPE_KEYWORDS)
+    for kw in keywords
+}
+_RE_PAGE_TYPE_KEYWORD = re.compile(
+    '(?=(' + '|'.join(re.escape(kw) for kw in _PAGE_TYPE_PRIORITY) + '))'
+)
+
+
+def _infer_page_type(text: str) -> str:
+    """Infer a page type from keywords in free text."""
+    best = len(_PAGE_TYPE_KEYWORDS)
+    for match in _RE_PAGE_TYPE_KEYWORD.finditer(text.lower()):
+        priority = _PAGE_TYPE_PRIORITY[match.group(1)]
+        if priority < best:
+            best = priority
+            if best == 0:
+                break
+    if best < len(_PAGE_TYPE_KEYWORDS):
+        return _PAGE_TYPE_KEYWORDS[best][0]
+    return 'Bill Detail'
+
+
+# Repair and fallback patterns used by JSONParser on malformed responses
+_RE_TRAILING_COMMA_OBJ = re.compile(r',\s*}')
+_RE_TRAILING_COMMA_ARR = re.compile(r',\s*]')
+_RE_ADJACENT_OBJECTS = re.compile(r'}\s*{')
+_RE_UNQUOTED_KEY = re.compile(r'(\s*)(\w+)(\s*):(\s*)')
+_RE_DOUBLE_QUOTED_KEY = re.compile(r'""(\w+)""')
+_RE_LOOSE_ITEM = re.compile(
+    r'item_name["\s:]+([^"]+)["\s,]+.*?'
+    r'item_amount["\s:]+(\d+\.?\d*)',
+    re.DOTALL | re.IGNORECASE
+)
+_RE_PAGE_TYPE = re.compile(r'"page_type"\s*:\s*"([^"]+)"', re.IGNORECASE)
+# A JSON string literal; the closing quote is optional so a string cut off
+# by truncation still gets its newlines flattened.
+_RE_JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"?', re.DOTALL)
+_NEWLINES_TO_SPACE = {ord('\n'): ' ', ord('\r'): ' '}
+_RE_BRACE = re.compile(r'[{}]')
+# BOM, NUL and zero-width characters are dropped; a no-break space becomes
+# a plain space so words in item names stay separated
+_BAD_CHARS = dict.fromkeys([0x0000, 0xFEFF, 0x200B, 0x200C, 0x200D])
+_BAD_CHARS[0x00A0] = ' '
+
 
 class JSONParser:
     """
@@ -22,9 +103,15 @@ class JSONParser:
             r'```(?:json)?\s*([\s\S]*?)```',
             re.IGNORECASE
         )
-        self.json_object_pattern = re.compile(
-            r'\{[\s\S]*\}',
-            re.DOTALL
+        # Any single item field (or an object close) for one-pass salvage;
+        # the group name says which alternative matched
+        self.item_field_pattern = re.compile(
+            r'"item_name"\s*:\s*"(?P<name>[^"]+)"'
+            r'|"item_amount"\s*:\s*(?P<amount>[\d,]+\.?\d*)'
+            r'|"item_rate"\s*:\s*(?P<rate>[\d,]+\.?\d*)'
+            r'|"item_quantity"\s*:\s*(?P<quantity>[\d,]+\.?\d*)'
+            r'|(?P<closed>\})',
+            re.IGNORECASE
         )
     
     def parse(self, text: str, page_num: int = 1) -> Optional[Dict]:
@@ -61,15 +148,18 @@ class JSONParser:
         if result:
             return result
         
-        # Strategy 3: Extract JSON object
-        result = self._try_json_object_parse(text, page_num)
-        if result:
-            return result
-        
-        # Strategy 4: Fix and retry
-        result = self._try_fixed_parse(text, page_num)
-        if result:
-            return result
+        # Strategies 3 and 4 both work on the outermost object; slice it once
+        json_text = self._slice_json_object(text)
+        if json_text:
+            # Strategy 3: Extract JSON object
+            result = self._try_json_object_parse(json_text, page_num)
+            if result:
+                return result
+            
+            # Strategy 4: Fix and retry
+            result = self._try_fixed_parse(json_text, page_num)
+            if result:
+                return result
         
         # Strategy 5: Regex extraction (last resort)
         result = self._try_regex_extraction(text, page_num)
@@ -79,88 +169,132 @@ class JSONParser:
         logger.warning(f"[Page {page_num}] All parsing strategies failed")
         return None
     
+    def parse_pages(self, text: str, page_num: int = 1) -> Optional[List[Dict]]:
+        """
+        Parse a multi-page batch response of the form {"pages": [...]}.
+        
+        Args:
+            text: Raw text from LLM
+            page_num: First page number of the batch, for logging
+            
+        Returns:
+            List of page dicts with valid structure, or None if the
+            response could not be parsed
+        """
+        if not text or not text.strip():
+            logger.warning(f"[Page {page_num}] Empty batch response")
+            return None
+        
+        text = text.strip()
+        json_text = self._slice_json_object(text)
+        candidates = [text]
+        if json_text:
+            candidates.append(json_text)
+            candidates.append(self._fix_json_issues(json_text))
+        
+        for candidate in candidates:
+            try:
+                data = _json_loads(candidate)
+            except ValueError:
+                continue
+            if isinstance(data, dict) and isinstance(data.get('pages'), list):
+                pages = [page for page in data['pages'] if self._validate_structure(page)]
+                logger.debug(f"[Page {page_num}] Batch parse found {len(pages)} pages")
+                return pages
+        
+        logger.warning(f"[Page {page_num}] Batch response parsing failed")
+        return None
+    
     def _try_direct_parse(self, text: str, page_num: int) -> Optional[Dict]:
         """Try to parse text directly as JSON."""
         try:
-            data = json.loads(text)
+            data = _json_loads(text)
             if self._validate_structure(data):
                 logger.debug(f"[Page {page_num}] Direct parse successful")
                 return data
-        except json.JSONDecodeError:
+        except ValueError:
             pass
         return None
     
     def _try_code_block_parse(self, text: str, page_num: int) -> Optional[Dict]:
         """Extract JSON from markdown code blocks."""
-        match = self.json_block_pattern.search(text)
+        # A plain find rules out fence-less responses before the regex runs
+        fence = text.find('```')
+        if fence == -1:
+            return None
+        match = self.json_block_pattern.search(text, fence)
         if match:
             json_text = match.group(1).strip()
             try:
-                data = json.loads(json_text)
+                data = _json_loads(json_text)
                 if self._validate_structure(data):
                     logger.debug(f"[Page {page_num}] Code block parse successful")
                     return data
-            except json.JSONDecodeError:
+            except ValueError:
                 pass
         return None
     
-    def _try_json_object_parse(self, text: str, page_num: int) -> Optional[Dict]:
-        """Extract JSON object using regex."""
-        match = self.json_object_pattern.search(text)
-        if match:
-            json_text = match.group()
-            try:
-                data = json.loads(json_text)
-                if self._validate_structure(data):
-                    logger.debug(f"[Page {page_num}] JSON object parse successful")
-                    return data
-            except json.JSONDecodeError:
-                pass
+    def _try_json_object_parse(self, json_text: str, page_num: int) -> Optional[Dict]:
+        """Parse the outermost JSON object sliced from surrounding text."""
+        try:
+            data = _json_loads(json_text)
+            if self._validate_structure(data):
+                logger.debug(f"[Page {page_num}] JSON object parse successful")
+                return data
+        except ValueError:
+            pass
         return None
     
-    def _try_fixed_parse(self, text: str, page_num: int) -> Optional[Dict]:
-        """Apply fixes and try to parse."""
-        # Extract potential JSON portion
-        match = self.json_object_pattern.search(text)
-        if not match:
-            return None
-        
-        json_text = match.group()
-        
+    def _try_fixed_parse(self, json_text: str, page_num: int) -> Optional[Dict]:
+        """Apply fixes to the sliced JSON object and try to parse."""
         # Apply progressive fixes
         fixed_text = self._fix_json_issues(json_text)
         
         try:
-            data = json.loads(fixed_text)
+            data = _json_loads(fixed_text)
             if self._validate_structure(data):
                 logger.debug(f"[Page {page_num}] Fixed parse successful")
                 return data
-        except json.JSONDecodeError as e:
+        except ValueError as e:
             logger.debug(f"[Page {page_num}] Fixed parse failed: {e}")
         
         return None
     
+    def _slice_json_object(self, text: str) -> Optional[str]:
+        """
+        Return the span from the first '{' to the last '}'.
+        
+        Plain index scans instead of a greedy regex, which backtracks
+        across the whole response.
+        """
+        start = text.find('{')
+        end = text.rfind('}')
+        if start == -1 or end <= start:
+            return None
+        return text[start:end + 1]
+    
     def _fix_json_issues(self, text: str) -> str:
         """
         Fix common JSON issues in LLM outputs.
         """
-        # Step 1: Remove any BOM or weird unicode
-        text = text.encode('utf-8', errors='ignore').decode('utf-8')
+        # Step 1: Remove any BOM or weird unicode (nothing to do for ASCII)
+        if not text.isascii():
+            text = text.translate(_BAD_CHARS)
         
         # Step 2: Fix newlines inside strings
         text = self._fix_string_newlines(text)
         
         # Step 3: Fix trailing commas
-        text = re.sub(r',\s*}', '}', text)
-        text = re.sub(r',\s*]', ']', text)
+        text = _RE_TRAILING_COMMA_OBJ.sub('}', text)
+        text = _RE_TRAILING_COMMA_ARR.sub(']', text)
         
         # Step 4: Fix missing commas between items
-        text = re.sub(r'}\s*{', '},{', text)
+        text = _RE_ADJACENT_OBJECTS.sub('},{', text)
         
         # Step 5: Fix unquoted keys (rare but possible)
-        text = re.sub(r'(\s*)(\w+)(\s*):(\s*)', r'\1"\2"\3:\4', text)
+        text = _RE_UNQUOTED_KEY.sub(r'\1"\2"\3:\4', text)
         # But this might double-quote already quoted keys, so fix that
-        text = re.sub(r'""(\w+)""', r'"\1"', text)
+        text = _RE_DOUBLE_QUOTED_KEY.sub(r'"\1"', text)
         
         # Step 6: Fix truncated JSON
         text = self._fix_truncation(text)
@@ -173,48 +307,26 @@ class JSONParser:
     
     def _fix_string_newlines(self, text: str) -> str:
         """Remove newlines from inside JSON strings."""
-        result = []
-        in_string = False
-        escape_next = False
-        
-        for char in text:
-            if escape_next:
-                result.append(char)
-                escape_next = False
-                continue
-            
-            if char == '\\':
-                result.append(char)
-                escape_next = True
-                continue
-            
-            if char == '"':
-                in_string = not in_string
-            
-            if char in '\n\r' and in_string:
-                result.append(' ')
-            else:
-                result.append(char)
-        
-        return ''.join(result)
+        return _RE_JSON_STRING.sub(
+            lambda m: m.group(0).translate(_NEWLINES_TO_SPACE), text
+        )
     
     def _fix_truncation(self, text: str) -> str:
         """Fix truncated JSON by closing open brackets."""
         # Count brackets
-        open_braces = text.count('{') - text.count('}')
-        open_brackets = text.count('[') - text.count(']')
+        open_braces, open_brackets = self._bracket_balance(text)
         
         if open_braces > 0 or open_brackets > 0:
             # Try to remove incomplete last item
             # Look for last complete item
             last_complete = self._find_last_complete_item(text)
             if last_complete > 0:
+                # Only the dropped tail needs counting, not the whole text again
+                tail_braces, tail_brackets = self._bracket_balance(text[last_complete + 1:])
+                open_braces -= tail_braces
+                open_brackets -= tail_brackets
                 text = text[:last_complete + 1]
             
-            # Recount and close
-            open_braces = text.count('{') - text.count('}')
-            open_brackets = text.count('[') - text.count(']')
-            
             # Add closing brackets
             text = text.rstrip(',').rstrip()
             text += ']' * max(0, open_brackets)
@@ -222,77 +334,52 @@ class JSONParser:
         
         return text
     
+    @staticmethod
+    def _bracket_balance(text: str) -> Tuple[int, int]:
+        """Return (unclosed braces, unclosed brackets) in text."""
+        # str.count is a C scan per character; measured well ahead of
+        # collections.Counter, which builds a dict entry per distinct char.
+        return (
+            text.count('{') - text.count('}'),
+            text.count('[') - text.count(']'),
+        )
+    
     def _find_last_complete_item(self, text: str) -> int:
         """Find the position of the last complete JSON item."""
-        # Look for the last properly closed item in bill_items
-        # Pattern: complete object ending with }
-        
-        # Find all complete objects
-        positions = []
+        # Look for the last top-level object that looks like a bill item.
+        # Only brace characters matter for depth, so let the regex engine
+        # skip everything in between instead of visiting each char.
+        last = -1
         depth = 0
         start = -1
         
-        for i, char in enumerate(text):
-            if char == '{':
+        for match in _RE_BRACE.finditer(text):
+            i = match.start()
+            if match.group() == '{':
                 if depth == 0:
                     start = i
                 depth += 1
-            elif char == '}':
+            else:
                 depth -= 1
                 if depth == 0 and start >= 0:
                     # Check if this looks like a bill item
                     snippet = text[start:i+1]
                     if '"item_name"' in snippet or '"item_amount"' in snippet:
-                        positions.append(i)
+                        last = i
         
-        return positions[-1] if positions else -1
+        return last
     
     def _try_regex_extraction(self, text: str, page_num: int) -> Optional[Dict]:
         """
         Last resort: Extract items using regex patterns.
         Handles severely malformed JSON.
         """
-        items = []
-        
-        # Pattern 1: item_name followed by item_amount
-        pattern1 = re.compile(
-            r'"item_name"\s*:\s*"([^"]+)"[^}]*?'
-            r'"item_amount"\s*:\s*([\d,]+\.?\d*)',
-            re.DOTALL | re.IGNORECASE
-        )
-        
-        # Pattern 2: item_amount followed by item_name
-        pattern2 = re.compile(
-            r'"item_amount"\s*:\s*([\d,]+\.?\d*)[^}]*?'
-            r'"item_name"\s*:\s*"([^"]+)"',
-            re.DOTALL | re.IGNORECASE
-        )
-        
-        # Pattern 3: Looser pattern for edge cases
-        pattern3 = re.compile(
-            r'item_name["\s:]+([^"]+)["\s,]+.*?'
-            r'item_amount["\s:]+(\d+\.?\d*)',
-            re.DOTALL | re.IGNORECASE
-        )
-        
-        # Try patterns in order
-        for match in pattern1.finditer(text):
-            name = match.group(1).strip()
-            amount = self._parse_number(match.group(2))
-            if name and amount > 0:
-                item = self._extract_full_item(text, match.start(), match.end(), name, amount)
-                items.append(item)
-        
-        if not items:
-            for match in pattern2.finditer(text):
-                amount = self._parse_number(match.group(1))
-                name = match.group(2).strip()
-                if name and amount > 0:
-                    item = self._extract_full_item(text, match.start(), match.end(), name, amount)
-                    items.append(item)
+        # Pattern 1: quoted item fields, scanned in a single pass
+        items = self._scan_item_fields(text)
         
+        # Pattern 2: Looser pattern for edge cases
         if not items:
-            for match in pattern3.finditer(text):
+            for match in _RE_LOOSE_ITEM.finditer(text):
                 name = match.group(1).strip().strip('"')
                 amount = self._parse_number(match.group(2))
                 if name and amount > 0:
@@ -316,42 +403,59 @@ class JSONParser:
         
         return None
     
-    def _extract_full_item(self, text: str, start: int, end: int, 
-                          name: str, amount: float) -> Dict:
-        """Extract full item including rate and quantity from context."""
-        # Look for rate and quantity in surrounding context
-        context_start = max(0, start - 50)
-        context_end = min(len(text), end + 200)
-        context = text[context_start:context_end]
-        
-        item = {
-            "item_name": name,
-            "item_amount": amount
-        }
+    def _scan_item_fields(self, text: str) -> List[Dict]:
+        """
+        Collect items from quoted item fields in one pass over the text.
         
-        # Extract rate
-        rate_match = re.search(
-            r'"item_rate"\s*:\s*([\d,]+\.?\d*)',
-            context,
-            re.IGNORECASE
-        )
-        if rate_match:
-            rate = self._parse_number(rate_match.group(1))
-            if rate > 0:
-                item["item_rate"] = rate
+        Fields are grouped into a row until its object closes or a field
+        repeats, so name/amount may appear in either order and rate/quantity
+        are attached from the same object without re-scanning the text.
+        Rows are kept as parallel column lists and only surviving rows are
+        turned into item dicts.
+        """
+        names, amounts, rates, quantities = [], [], [], []
+        row_open = False
         
-        # Extract quantity
-        qty_match = re.search(
-            r'"item_quantity"\s*:\s*([\d,]+\.?\d*)',
-            context,
-            re.IGNORECASE
-        )
-        if qty_match:
-            qty = self._parse_number(qty_match.group(1))
-            if qty > 0:
-                item["item_quantity"] = qty
+        for match in self.item_field_pattern.finditer(text):
+            field = match.lastgroup
+            
+            if field == 'closed':
+                row_open = False
+                continue
+            
+            if row_open and ((field == 'name' and names[-1] is not None) or
+                             (field == 'amount' and amounts[-1] is not None)):
+                row_open = False
+            
+            if not row_open:
+                names.append(None)
+                amounts.append(None)
+                rates.append(None)
+                quantities.append(None)
+                row_open = True
+            
+            value = match.group(field)
+            if field == 'name':
+                names[-1] = value.strip()
+            elif field == 'amount':
+                amounts[-1] = self._parse_number(value)
+            elif field == 'rate':
+                rates[-1] = self._parse_number(value)
+            else:
+                quantities[-1] = self._parse_number(value)
         
-        return item
+        items = []
+        for name, amount, rate, quantity in zip(names, amounts, rates, quantities):
+            if not name or not amount:
+                continue
+            item = {"item_name": name, "item_amount": amount}
+            if rate:
+                item["item_rate"] = rate
+            if quantity:
+                item["item_quantity"] = quantity
+            items.append(item)
+        
+        return items
     
     def _parse_number(self, s: str) -> float:
         """Parse a number string, handling commas and currency symbols."""
@@ -366,54 +470,30 @@ class JSONParser:
     
     def _deduplicate_items(self, items: List[Dict]) -> List[Dict]:
         """Remove duplicate items based on name and amount."""
-        seen = set()
-        unique = []
+        # Insertion-ordered dict doubles as the seen-set and the result
+        unique = {}
         
         for item in items:
-            # Create a key (lowercase name + amount)
+            # Signature: casefolded name + amount rounded to paise
             key = (
-                item.get('item_name', '').lower().strip(),
+                item.get('item_name', '').strip().casefold(),
                 round(item.get('item_amount', 0), 2)
             )
             
-            if key not in seen and key[0] and key[1] > 0:
-                seen.add(key)
-                unique.append(item)
+            if key[0] and key[1] > 0:
+                unique.setdefault(key, item)
         
-        return unique
+        return list(unique.values())
     
     def _detect_page_type(self, text: str) -> str:
         """Detect page type from text content."""
-        text_lower = text.lower()
-        
         # Check for explicit page_type in response
-        type_match = re.search(
-            r'"page_type"\s*:\s*"([^"]+)"',
-            text,
-            re.IGNORECASE
-        )
-        if type_match:
-            explicit_type = type_match.group(1)
-            if explicit_type in ['Pharmacy', 'Final Bill', 'Bill Detail', 
-                                'Investigation', 'Consultation', 'Room Charges']:
-                return explicit_type
+        type_match = _RE_PAGE_TYPE.search(text)
+        if type_match and type_match.group(1) in _EXPLICIT_PAGE_TYPES:
+            return type_match.group(1)
         
         # Infer from content
-        if any(kw in text_lower for kw in ['pharmacy', 'medicine', 'tablet', 
-                                           'capsule', 'syrup', 'injection', 'mg', 'ml']):
-            return 'Pharmacy'
-        elif any(kw in text_lower for kw in ['final bill', 'grand total', 
-                                              'total payable', 'net amount']):
-            return 'Final Bill'
-        elif any(kw in text_lower for kw in ['investigation', 'lab', 'test', 
-                                              'pathology', 'radiology']):
-            return 'Investigation'
-        elif any(kw in text_lower for kw in ['consultation', 'doctor', 'visit']):
-            return 'Consultation'
-        elif any(kw in text_lower for kw in ['room', 'bed', 'accommodation']):
-            return 'Room Charges'
-        
-        return 'Bill Detail'
+        return _infer_page_type(text)
     
     def _validate_structure(self, data: Any) -> bool:
         """
@@ -423,23 +503,129 @@ class JSONParser:
             return False
         
         # Must have bill_items (even if empty)
-        if 'bill_items' not in data:
+        items = data.get('bill_items')
+        if not isinstance(items, list):
             return False
         
-        if not isinstance(data['bill_items'], list):
-            return False
+        # Every item must be an object; items missing fields are dropped
+        # later by ResponseValidator, so only the type is checked here
+        return all(isinstance(item, dict) for item in items)
+
+
+class TextLineItemExtractor:
+    """
+    Extracts line items directly from a digital PDF's text layer.
+    
+    Handles the common "description  qty  [rate]  amount" row layout so
+    well-structured digital pages can skip the vision model entirely.
+    Deliberately conservative: anything it can't account for is left to
+    the model.
+    """
+    
+    def __init__(self, min_items: int = 3, min_coverage: float = 0.8):
+        """
+        Args:
+            min_items: Minimum rows required to trust the text layer
+            min_coverage: Minimum share of amount-ending lines that must
+                parse as item or skipped (total/tax) rows
+        """
+        self.min_items = min_items
+        self.min_coverage = min_coverage
+        
+        def money(group: str) -> str:
+            return (r'(?:Rs\.?|₹|INR)?\s*'
+                    rf'(?P<{group}>\d{{1,3}}(?:,\d{{3}})+(?:\.\d{{1,2}})?|\d+\.\d{{1,2}})')
+        
+        # Description, quantity, rate, amount
+        self.full_row_pattern = re.compile(
+            rf'^(?P<name>.+?)\s+(?P<qty>\d+(?:\.\d+)?)\s+{money("rate")}\s+{money("amount")}\s*$'
+        )
+        # Description, quantity, amount
+        self.short_row_pattern = re.compile(
+            rf'^(?P<name>.+?)\s+(?P<qty>\d{{1,3}})\s+{money("amount")}\s*$'
+        )
+        self.amount_line_pattern = re.compile(rf'{money("amount")}\s*$')
+        self.letters_pattern = re.compile(r'[A-Za-z]{3}')
+        self.validator = ResponseValidator()
+    
+    def try_extract(self, text: str) -> Optional[Dict]:
+        """
+        Extract items from page text if the layout is recognized.
         
-        # Validate items have required fields
-        for item in data['bill_items']:
-            if not isinstance(item, dict):
-                return False
-            # Must have at least item_name and item_amount
-            if 'item_name' not in item or 'item_amount' not in item:
-                # Try alternative field names
-                if not ('name' in item or 'description' in item):
-                    continue  # Skip invalid items
-        
-        return True
+        Args:
+            text: Text layer of a digital PDF page
+            
+        Returns:
+            Page dict with page_type and bill_items, or None if the page
+            should go to the model instead
+        """
+        if not text:
+            return None
+        
+        items = []
+        amount_lines = 0
+        accounted = 0
+        
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or not self.amount_line_pattern.search(line):
+                continue
+            amount_lines += 1
+            
+            item = self._parse_row(line)
+            if item is None:
+                # Totals and tax lines are expected to be left out
+                if self.validator.skip_pattern.search(line.lower()):
+                    accounted += 1
+                continue
+            accounted += 1
+            
+            cleaned, _ = self.validator.validate_item(item)
+            if cleaned:
+                items.append(cleaned)
+        
+        if len(items) < self.min_items or accounted < amount_lines * self.min_coverage:
+            return None
+        
+        return {
+            "page_type": _infer_page_type(text),
+            "bill_items": items
+        }
+    
+    def _parse_row(self, line: str) -> Optional[Dict]:
+        """Parse one text row into a raw item dict, or None if unrecognized."""
+        match = self.full_row_pattern.match(line)
+        if match:
+            qty = float(match.group('qty'))
+            rate = float(match.group('rate').replace(',', ''))
+            amount = float(match.group('amount').replace(',', ''))
+            # Rows that don't add up (discounts, misread columns) go to the model
+            if abs(qty * rate - amount) > max(1.0, amount * 0.01):
+                return None
+            item = {"item_rate": rate}
+        else:
+            match = self.short_row_pattern.match(line)
+            if not match:
+                return None
+            qty = float(match.group('qty'))
+            amount = float(match.group('amount').replace(',', ''))
+            item = {}
+        
+        name = match.group('name')
+        if not self.letters_pattern.search(name):
+            return None
+        
+        item.update({"item_name": name, "item_amount": amount, "item_quantity": qty})
+        return item
+
+
+# Field coercion patterns used by ResponseValidator on every item
+_RE_LEADING_INDEX = re.compile(r'^[\d\.\-\)\]\s]+')
+# Numbers start at a digit, or at a bare '.5' not glued to a word, so currency
+# marks and units like "Rs.500", "₹" or "No.3" are skipped without stripping.
+# Amount commas cover both 1,234,567 and lakh-style 12,34,567 grouping.
+_RE_MONEY = re.compile(r'\d[\d,]*(?:\.\d+)?|(?<!\w)\.\d+')
+_RE_QUANTITY = re.compile(r'\d+(?:\.\d+)?|(?<!\w)\.\d+')
 
 
 class ResponseValidator:
@@ -456,6 +642,10 @@ class ResponseValidator:
             'advance', 'deposit', 'adjustment', 'balance',
             'page', 'continued', 'header', 'footer'
         ]
+        # One alternation instead of a substring test per keyword
+        self.skip_pattern = re.compile(
+            '|'.join(re.escape(kw) for kw in self.skip_keywords)
+        )
         
         # Minimum item name length
         self.min_name_length = 3
@@ -480,14 +670,19 @@ class ResponseValidator:
         cleaned_items = []
         warnings = []
         
-        for item in data.get('bill_items', []):
-            cleaned_item, item_warnings = self._validate_item(item)
+        for item in data.get('bill_items', ()):
+            cleaned_item, item_warnings = self.validate_item(item)
             if cleaned_item:
                 cleaned_items.append(cleaned_item)
             warnings.extend(item_warnings)
         
+        # Map free-form types from the model onto the known set
+        page_type = data.get('page_type') or 'Bill Detail'
+        if page_type not in _EXPLICIT_PAGE_TYPES:
+            page_type = _infer_page_type(str(page_type))
+        
         result = {
-            "page_type": data.get('page_type', 'Bill Detail'),
+            "page_type": page_type,
             "bill_items": cleaned_items
         }
         
@@ -496,7 +691,7 @@ class ResponseValidator:
         
         return result
     
-    def _validate_item(self, item: Dict) -> Tuple[Optional[Dict], List[str]]:
+    def validate_item(self, item: Dict) -> Tuple[Optional[Dict], List[str]]:
         """
         Validate and clean a single item.
         
@@ -505,26 +700,30 @@ class ResponseValidator:
         """
         warnings = []
         
-        # Get item name
-        name = item.get('item_name', item.get('name', item.get('description', '')))
-        name = str(name).strip() if name else ''
+        # Get item name (aliases only looked up when the primary key is missing)
+        name = item.get('item_name') or item.get('name') or item.get('description')
+        if not name:
+            return None, ["Skipped item with short name: ''"]
+        name = name.strip() if isinstance(name, str) else str(name).strip()
         
-        # Skip if name is empty or too short
+        # Skip if name is too short
         if len(name) < self.min_name_length:
             return None, [f"Skipped item with short name: '{name}'"]
         
-        # Skip if name matches skip keywords
-        name_lower = name.lower()
-        if any(kw in name_lower for kw in self.skip_keywords):
-            return None, [f"Skipped total/header row: '{name}'"]
-        
         # Get amount
-        amount = self._parse_amount(item.get('item_amount', item.get('amount', 0)))
+        amount = item.get('item_amount')
+        if amount is None:
+            amount = item.get('amount', 0)
+        amount = self._parse_amount(amount)
         
-        # Skip zero or negative amounts
+        # Skip zero or negative amounts before the keyword scan
         if amount <= 0:
             return None, [f"Skipped item with invalid amount: '{name}' = {amount}"]
         
+        # Skip if name matches skip keywords
+        if self.skip_pattern.search(name.lower()):
+            return None, [f"Skipped total/header row: '{name}'"]
+        
         # Build cleaned item
         cleaned = {
             "item_name": self._clean_name(name),
@@ -532,11 +731,15 @@ class ResponseValidator:
         }
         
         # Add optional fields if valid
-        rate = self._parse_amount(item.get('item_rate', item.get('rate', 0)))
+        rate = item.get('item_rate')
+        rate = self._parse_amount(rate if rate is not None else item.get('rate', 0))
         if rate > 0:
             cleaned["item_rate"] = round(rate, 2)
         
-        quantity = self._parse_quantity(item.get('item_quantity', item.get('quantity', 0)))
+        quantity = item.get('item_quantity')
+        quantity = self._parse_quantity(
+            quantity if quantity is not None else item.get('quantity', 0)
+        )
         if quantity > 0:
             cleaned["item_quantity"] = quantity
         
@@ -554,7 +757,7 @@ class ResponseValidator:
     def _clean_name(self, name: str) -> str:
         """Clean item name."""
         # Remove leading numbers/symbols
-        name = re.sub(r'^[\d\.\-\)\]\s]+', '', name)
+        name = _RE_LEADING_INDEX.sub('', name)
         # Remove trailing punctuation
         name = name.strip('.,;:-() ')
         # Normalize whitespace
@@ -567,12 +770,8 @@ class ResponseValidator:
             return 0.0
         if isinstance(value, (int, float)):
             return float(value)
-        try:
-            s = str(value).replace(',', '').replace('₹', '').replace('Rs.', '').replace('Rs', '').strip()
-            match = re.search(r'[\d.]+', s)
-            return float(match.group()) if match else 0.0
-        except (ValueError, TypeError):
-            return 0.0
+        match = _RE_MONEY.search(str(value))
+        return float(match.group().replace(',', '')) if match else 0.0
     
     def _parse_quantity(self, value) -> float:
         """Parse quantity."""
@@ -580,9 +779,5 @@ class ResponseValidator:
             return 0.0
         if isinstance(value, (int, float)):
             return float(value)
-        try:
-            s = re.sub(r'\s*(No|Nos|Units?|Pcs?|Qty)\.?\s*', '', str(value), flags=re.IGNORECASE)
-            match = re.search(r'[\d.]+', s)
-            return float(match.group()) if match else 0.0
-        except (ValueError, TypeError):
-            return 0.0
\ No newline at end of file
+        match = _RE_QUANTITY.search(str(value))
+        return float(match.group()) if match else 0.0
\ No newline at end of file
@@ -4,11 +4,18 @@ preprocessor.py - Image preprocessing for optimal OCR/Vision extraction
 
 import logging
 from io import BytesIO
-from typing import Tuple, Optional
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+from typing import List, Tuple, Optional
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps, ImageStat
 
 logger = logging.getLogger(__name__)
 
+JPEG_QUALITY = 85  # Encoding quality for images sent to the model
+OCR_THRESHOLD = 128  # Gray level above which OCR binarization goes white
+CONTRAST_BOOST = 1.2  # Contrast factor applied after auto-contrast
+
+# Grayscale -> black/white lookup table, so point() needs no Python callback
+_BINARIZE_LUT = [255 if p > OCR_THRESHOLD else 0 for p in range(256)]
+
 
 class ImagePreprocessor:
     """
@@ -20,6 +27,11 @@ class ImagePreprocessor:
     TARGET_MAX_DIM = 1600  # Higher res for better text recognition
     TARGET_MIN_DIM = 800   # Minimum for readable text
     
+    # Pages with a rich text layer also send that text to the model, so
+    # the image only needs to be legible, not OCR-grade
+    TEXT_RICH_MAX_DIM = 1000
+    TEXT_RICH_MIN_CHARS = 500
+    
     # Quality thresholds
     MIN_CONTRAST_RATIO = 0.3
     OPTIMAL_DPI = 150
@@ -43,13 +55,18 @@ class ImagePreprocessor:
         self.denoise = denoise
         self.auto_orient = auto_orient
     
-    def process(self, image: Image.Image, page_num: int = 1) -> Image.Image:
+    def process(self, image: Image.Image, page_num: int = 1,
+                target_max_dim: Optional[int] = None,
+                fast_path: bool = False) -> Image.Image:
         """
         Main preprocessing pipeline.
         
         Args:
             image: PIL Image to process
             page_num: Page number for logging
+            target_max_dim: Per-image override of the maximum dimension
+            fast_path: Image is a rendered digital PDF page (clean, high
+                contrast, no EXIF), so only resize and sharpen it
             
         Returns:
             Processed PIL Image
@@ -60,6 +77,12 @@ class ImagePreprocessor:
         # Step 1: Convert to RGB if needed
         image = self._ensure_rgb(image)
         
+        if fast_path:
+            image = self._smart_resize(image, page_num, target_max_dim)
+            image = self._sharpen_text(image)
+            logger.debug(f"[Page {page_num}] Final size: {image.size} (fast path)")
+            return image
+        
         # Step 2: Auto-orient based on EXIF
         if self.auto_orient:
             image = self._auto_orient(image)
@@ -69,7 +92,7 @@ class ImagePreprocessor:
         logger.debug(f"[Page {page_num}] Quality: {quality_info}")
         
         # Step 4: Resize to optimal dimensions
-        image = self._smart_resize(image, page_num)
+        image = self._smart_resize(image, page_num, target_max_dim)
         
         # Step 5: Enhance contrast if needed
         if self.enhance_contrast and quality_info.get('low_contrast', False):
@@ -85,12 +108,33 @@ class ImagePreprocessor:
         logger.debug(f"[Page {page_num}] Final size: {image.size}")
         return image
     
+    def is_upload_ready(self, image: Image.Image) -> bool:
+        """
+        Check if an encoded image can be sent to the model unchanged.
+        
+        Only inspects header data, so it is cheap on lazily opened images.
+        
+        Returns:
+            True for RGB JPEGs within the target size range that need
+            no EXIF rotation
+        """
+        if image.format != 'JPEG' or image.mode != 'RGB':
+            return False
+        if not self.TARGET_MIN_DIM <= max(image.size) <= self.target_max_dim:
+            return False
+        try:
+            orientation = image.getexif().get(0x0112, 1)  # EXIF Orientation
+        except Exception:
+            return False
+        return orientation == 1
+    
     def _ensure_rgb(self, image: Image.Image) -> Image.Image:
         """Convert image to RGB mode if needed."""
         if image.mode == 'RGBA':
             # Create white background for transparency
+            # getchannel copies only the alpha band; split() made all four
             background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
+            background.paste(image, mask=image.getchannel('A'))
             return background
         elif image.mode != 'RGB':
             return image.convert('RGB')
@@ -120,12 +164,10 @@ class ImagePreprocessor:
         try:
             # Convert to grayscale for analysis
             gray = image.convert('L')
-            pixels = list(gray.getdata())
             
-            # Check contrast (standard deviation of pixel values)
-            mean_val = sum(pixels) / len(pixels)
-            variance = sum((p - mean_val) ** 2 for p in pixels) / len(pixels)
-            std_dev = variance ** 0.5
+            # Check contrast (standard deviation of pixel values), computed
+            # by Pillow from the histogram rather than a per-pixel list
+            std_dev = ImageStat.Stat(gray).stddev[0]
             
             if std_dev < 40:  # Low contrast threshold
                 quality['low_contrast'] = True
@@ -143,18 +185,22 @@ class ImagePreprocessor:
         
         return quality
     
-    def _smart_resize(self, image: Image.Image, page_num: int = 1) -> Image.Image:
+    def _smart_resize(self, image: Image.Image, page_num: int = 1,
+                      target_max_dim: Optional[int] = None) -> Image.Image:
         """
         Intelligently resize image to optimal dimensions.
         
         - Maintains aspect ratio
         - Uses high-quality resampling
         - Avoids upscaling small images too much
+        
+        Downscaling happens in place, so the input image may be modified.
         """
+        target_max_dim = target_max_dim or self.target_max_dim
         width, height = image.size
         max_dim = max(width, height)
         
-        if max_dim <= self.target_max_dim:
+        if max_dim <= target_max_dim:
             # Only upscale if image is very small
             if max_dim < self.TARGET_MIN_DIM:
                 scale = self.TARGET_MIN_DIM / max_dim
@@ -164,27 +210,96 @@ class ImagePreprocessor:
                 return image.resize(new_size, Image.LANCZOS)
             return image
         
-        # Downscale large images
-        scale = self.target_max_dim / max_dim
-        new_size = (int(width * scale), int(height * scale))
-        logger.debug(f"[Page {page_num}] Downscaling from {image.size} to {new_size}")
-        return image.resize(new_size, Image.LANCZOS)
+        # Downscale large images in place; thumbnail() also pre-reduces by
+        # an integer factor before the LANCZOS pass on very large inputs
+        image.thumbnail((target_max_dim, target_max_dim), Image.LANCZOS)
+        logger.debug(f"[Page {page_num}] Downscaled from {(width, height)} to {image.size}")
+        return image
     
     def _enhance_contrast(self, image: Image.Image) -> Image.Image:
-        """Apply adaptive contrast enhancement."""
+        """
+        Apply adaptive contrast enhancement.
+        
+        Approximates ImageOps.autocontrast(cutoff=0.5) followed by
+        ImageEnhance.Contrast(1.2) to within one gray level, folded into one
+        lookup table so the pixels are read once from a histogram and
+        written once by point(). The table rounds where Pillow truncates,
+        and the contrast pivot comes from the stretched band means rather
+        than the grayscale mean, so the output is not bit-identical.
+        """
         try:
-            # Auto-contrast first
-            image = ImageOps.autocontrast(image, cutoff=0.5)
+            hist = image.histogram()
+            bands = len(image.getbands())
+            pixel_count = image.size[0] * image.size[1]
             
-            # Then apply moderate contrast boost
-            enhancer = ImageEnhance.Contrast(image)
-            image = enhancer.enhance(1.2)
+            # Auto-contrast stretch per band
+            stretch = [
+                self._autocontrast_lut(hist[band * 256:(band + 1) * 256], cutoff=0.5)
+                for band in range(bands)
+            ]
             
-            return image
+            # Contrast boost pivots on the mean luminance after the stretch,
+            # taken from the histograms instead of a grayscale copy
+            band_means = [
+                sum(count * lut[value] for value, count in enumerate(hist[band * 256:(band + 1) * 256]))
+                / pixel_count
+                for band, lut in enumerate(stretch)
+            ]
+            if bands >= 3:
+                luminance = (band_means[0] * 299 + band_means[1] * 587
+                             + band_means[2] * 114) / 1000
+            else:
+                luminance = band_means[0]
+            pivot = int(luminance + 0.5)
+            
+            lut = []
+            for band_lut in stretch:
+                lut.extend(
+                    min(255, max(0, int(pivot + CONTRAST_BOOST * (v - pivot) + 0.5)))
+                    for v in band_lut
+                )
+            return image.point(lut)
         except Exception as e:
             logger.warning(f"Contrast enhancement failed: {e}")
             return image
     
+    @staticmethod
+    def _autocontrast_lut(histogram: List[int], cutoff: float) -> List[int]:
+        """
+        Build the ImageOps.autocontrast mapping for one band.
+        
+        Args:
+            histogram: 256-entry histogram of the band
+            cutoff: Percent of pixels to ignore at each end
+            
+        Returns:
+            256-entry lookup table
+        """
+        h = list(histogram)
+        cut = sum(h) * cutoff // 100
+        
+        # Drop the darkest and brightest `cut` pixels before finding the range
+        for indices in (range(256), range(255, -1, -1)):
+            remaining = cut
+            for i in indices:
+                if remaining <= 0:
+                    break
+                if remaining > h[i]:
+                    remaining -= h[i]
+                    h[i] = 0
+                else:
+                    h[i] -= remaining
+                    remaining = 0
+        
+        lo = next((i for i in range(256) if h[i]), 0)
+        hi = next((i for i in range(255, -1, -1) if h[i]), 255)
+        if hi <= lo:
+            return list(range(256))
+        
+        scale = 255.0 / (hi - lo)
+        offset = -lo * scale
+        return [min(255, max(0, int(i * scale + offset))) for i in range(256)]
+    
     def _reduce_noise(self, image: Image.Image) -> Image.Image:
         """Apply noise reduction filter."""
         try:
@@ -203,6 +318,21 @@ class ImagePreprocessor:
             logger.warning(f"Sharpening failed: {e}")
             return image
     
+    def to_jpeg_blob(self, image: Image.Image, quality: int = JPEG_QUALITY) -> dict:
+        """
+        Encode an image once as an inline JPEG part for the Gemini API.
+        
+        Args:
+            image: Processed RGB PIL Image
+            quality: JPEG quality (1-95)
+            
+        Returns:
+            {"mime_type": "image/jpeg", "data": bytes} blob
+        """
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+    
     def process_for_ocr(self, image: Image.Image) -> Image.Image:
         """
         Process image specifically for OCR (grayscale + binarization).
@@ -213,8 +343,7 @@ class ImagePreprocessor:
         
         # Apply adaptive thresholding (simple version)
         # For true adaptive thresholding, would need OpenCV
-        threshold = 128
-        return gray.point(lambda p: 255 if p > threshold else 0)
+        return gray.point(_BINARIZE_LUT)
 
 
 class PDFPageConverter:
@@ -250,15 +379,35 @@ class PDFPageConverter:
         # Extract text first (for digital PDFs)
         text = pdf_page.get_text("text").strip()
         
-        # Convert to image with zoom
-        matrix = fitz.Matrix(self.zoom, self.zoom)
-        pix = pdf_page.get_pixmap(matrix=matrix)
+        # Text-rich pages go out with their text layer, so a smaller
+        # image is enough and costs fewer vision tokens
+        max_dim = self.max_dim
+        if len(text) >= ImagePreprocessor.TEXT_RICH_MIN_CHARS:
+            max_dim = min(max_dim, ImagePreprocessor.TEXT_RICH_MAX_DIM)
+        logger.debug(f"[Page {page_num}] Target resolution: {max_dim}px "
+                    f"({len(text)} text chars)")
+        
+        # Rasterize at the final size rather than at full zoom followed by
+        # a LANCZOS downscale. One pixel of headroom keeps the rasterizer's
+        # rounding from producing max_dim + 1 and triggering a resize anyway.
+        longest_side = max(pdf_page.rect.width, pdf_page.rect.height)
+        zoom = self.zoom
+        if longest_side > 0:
+            zoom = min(zoom, (max_dim - 1) / longest_side)
+        matrix = fitz.Matrix(zoom, zoom)
+        # Render straight to RGB so no alpha channel needs stripping later
+        pix = pdf_page.get_pixmap(matrix=matrix, alpha=False)
         
-        # Convert to PIL Image
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        # Convert to PIL Image. samples_mv is a view of the pixmap, so the
+        # only copy is Pillow's own unpack into its pixel layout (RGB is
+        # padded internally, so frombuffer could not share it anyway).
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv,
+                              "raw", "RGB", pix.stride)
         
-        # Apply preprocessing
-        img = self.preprocessor.process(img, page_num)
+        # Apply preprocessing; digital pages skip the quality analysis and
+        # the contrast/noise fixes meant for scans
+        img = self.preprocessor.process(img, page_num, target_max_dim=max_dim,
+                                        fast_path=self._is_digital_text(text))
         
         return img, text
     
@@ -269,6 +418,101 @@ class PDFPageConverter:
         Returns:
             True if page appears to be digital (has text layer)
         """
-        text = pdf_page.get_text("text").strip()
+        return self._is_digital_text(pdf_page.get_text("text").strip())
+    
+    @staticmethod
+    def _is_digital_text(text: str) -> bool:
+        """Decide digital vs scanned from an already extracted text layer."""
         # Consider digital if more than 100 characters of text
-        return len(text) > 100
\ No newline at end of file
+        return len(text) > 100
+
+
+def preprocess_image_bytes(image_content: bytes,
+                           target_max_dim: int = 1600) -> dict:
+    """
+    Decode, preprocess and JPEG-encode an uploaded image.
+    
+    Module-level so it can run in a worker process, keeping the
+    pure-Python parts of preprocessing off the request threads.
+    
+    Args:
+        image_content: Raw image file bytes
+        target_max_dim: Maximum dimension for the output image
+        
+    Returns:
+        {"mime_type": "image/jpeg", "data": bytes} blob
+    """
+    preprocessor = ImagePreprocessor(target_max_dim=target_max_dim)
+    img = Image.open(BytesIO(image_content))
+    return preprocessor.to_jpeg_blob(preprocessor.process(img, page_num=1))
+
+
+def render_pdf_pages(pdf_content: bytes, page_nums: List[int],
+                     zoom: float = 2.0,
+                     max_dim: int = 1600) -> List[Tuple[int, dict, str]]:
+    """
+    Render a subset of pages from raw PDF bytes to JPEG blobs.
+    
+    Opens its own document so it can run in a separate worker process;
+    PyMuPDF documents must not be shared between threads. Pages are
+    encoded once here, so only compact JPEG bytes cross the process
+    boundary and retries reuse the same upload payload.
+    
+    Args:
+        pdf_content: Raw PDF bytes, or a memoryview of them
+        page_nums: Page numbers to render (1-indexed)
+        zoom: Zoom factor for PDF to image conversion
+        max_dim: Maximum dimension for output images
+        
+    Returns:
+        List of (page number, JPEG blob, extracted text) tuples
+    """
+    import fitz
+    
+    converter = PDFPageConverter(zoom=zoom, max_dim=max_dim)
+    try:
+        pdf = fitz.open(stream=pdf_content, filetype="pdf")
+    except TypeError:
+        # Older PyMuPDF releases only accept bytes streams
+        pdf = fitz.open(stream=bytes(pdf_content), filetype="pdf")
+    try:
+        pages = []
+        for page_num in page_nums:
+            img, text = converter.convert_page(pdf[page_num - 1], page_num)
+            pages.append((page_num, converter.preprocessor.to_jpeg_blob(img), text))
+        return pages
+    finally:
+        pdf.close()
+
+
+def render_shared_pdf_pages(shm_name: str, size: int, page_nums: List[int],
+                            zoom: float = 2.0,
+                            max_dim: int = 1600) -> List[Tuple[int, dict, str]]:
+    """
+    Render a subset of pages from a PDF held in shared memory.
+    
+    Lets the parent process hand the document to render workers by name
+    instead of pickling its bytes into every task. PyMuPDF reads the
+    shared block through a memoryview, so the worker doesn't copy the PDF
+    either (except on PyMuPDF releases that only accept bytes).
+    
+    Args:
+        shm_name: Name of the SharedMemory block holding the PDF
+        size: PDF length in bytes (the block may be rounded up)
+        page_nums: Page numbers to render (1-indexed)
+        zoom: Zoom factor for PDF to image conversion
+        max_dim: Maximum dimension for output images
+        
+    Returns:
+        List of (page number, JPEG blob, extracted text) tuples
+    """
+    from multiprocessing import shared_memory
+    
+    shm = shared_memory.SharedMemory(name=shm_name)
+    view = shm.buf[:size]
+    try:
+        return render_pdf_pages(view, page_nums, zoom, max_dim)
+    finally:
+        # The document is closed by now; the view must go before the mapping
+        view.release()
+        shm.close()
\ No newline at end of file
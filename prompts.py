@@ -2,22 +2,13 @@
 prompts.py - Optimized prompts for Gemini 2.5 Flash medical invoice extraction
 """
 
-# Main extraction prompt - optimized for accuracy
-EXTRACTION_PROMPT_V1 = """You are a precise medical bill data extractor. Your task is to extract ALL line items from this hospital/medical bill image.
+import hashlib
+import re
+from functools import lru_cache
+from typing import Dict, Final, List, Optional, Tuple
 
-## OUTPUT FORMAT
-Return ONLY a JSON object in this exact format:
-{
-  "page_type": "Bill Detail",
-  "bill_items": [
-    {
-      "item_name": "Full item description",
-      "item_amount": 123.45,
-      "item_rate": 123.45,
-      "item_quantity": 1
-    }
-  ]
-}
+# Main extraction prompt - optimized for accuracy
+EXTRACTION_PROMPT_V1: Final[str] = """You are a precise medical bill data extractor. Your task is to extract ALL line items from this hospital/medical bill image.
 
 ## FIELD DEFINITIONS
 - page_type: One of "Bill Detail", "Pharmacy", "Final Bill", "Investigation", "Consultation", "Room Charges", "Services"
@@ -70,17 +61,14 @@ Example 2 - Investigation items:
   ]
 }
 
-## CRITICAL INSTRUCTIONS
-- Return ONLY valid JSON - no markdown, no explanations
-- If no items found, return: {"page_type": "Bill Detail", "bill_items": []}
-- Numbers must be numeric (123.45), not strings ("123.45")
-- Ensure all JSON brackets are properly closed
+## IF NOTHING IS BILLED
+If no items found, return: {"page_type": "Bill Detail", "bill_items": []}
 
 Extract all line items from this bill image now:"""
 
 
 # Alternative prompt with more structure
-EXTRACTION_PROMPT_V2 = """TASK: Extract line items from medical bill image
+EXTRACTION_PROMPT_V2: Final[str] = """TASK: Extract line items from medical bill image
 
 OUTPUT: JSON only, exact format:
 {"page_type":"TYPE","bill_items":[{"item_name":"NAME","item_amount":AMT,"item_rate":RATE,"item_quantity":QTY}]}
@@ -95,8 +83,46 @@ RULES:
 EXTRACT NOW:"""
 
 
+# Prompt for several pages in one call; page numbers are appended per batch
+BATCH_EXTRACTION_PROMPT: Final[str] = """You are a precise medical bill data extractor. You will receive several pages of a hospital/medical bill. Each page image is preceded by a "PAGE n:" marker, and digital pages are followed by their text layer.
+
+Extract ALL line items from EVERY page, keeping each item with the page it appears on.
+
+## OUTPUT FORMAT
+Return ONLY a JSON object with one entry per page, in the order given:
+{
+  "pages": [
+    {
+      "page_no": "1",
+      "page_type": "Bill Detail",
+      "bill_items": [
+        {"item_name": "Full item description", "item_amount": 123.45, "item_rate": 123.45, "item_quantity": 1}
+      ]
+    }
+  ]
+}
+
+## RULES
+1. item_amount = NET/TOTAL amount for the line (rightmost amount column)
+2. item_rate = Unit price/rate (if shown)
+3. item_quantity = Numeric quantity only
+4. Preserve FULL item descriptions - do not truncate
+5. SKIP: Headers, footers, column headers, totals, subtotals, tax and discount lines
+6. Include a page entry even if it has no items: "bill_items": []
+
+page_type options: Pharmacy, Investigation, Consultation, Room Charges, Bill Detail, Final Bill
+
+Return ONLY valid JSON. No markdown, no explanations."""
+
+
+def get_batch_prompt(page_nums: List[int]) -> str:
+    """Generate the batch prompt for the given page numbers."""
+    pages = ", ".join(str(n) for n in page_nums)
+    return f"{BATCH_EXTRACTION_PROMPT}\n\nPages in this request: {pages}"
+
+
 # Prompt for retries with additional context
-RETRY_PROMPT = """Previous extraction may have missed items. Please carefully re-examine this medical bill image.
+RETRY_PROMPT: Final[str] = """Previous extraction may have missed items. Please carefully re-examine this medical bill image.
 
 Focus on:
 1. Items in table rows with amounts
@@ -121,28 +147,19 @@ IMPORTANT:
 Extract all line items:"""
 
 
-# Prompt with text context (for digital PDFs)
-def get_text_enhanced_prompt(extracted_text: str) -> str:
-    """Generate prompt with text context for digital PDFs."""
-    # Truncate text if too long
-    if len(extracted_text) > 3000:
-        extracted_text = extracted_text[:3000] + "..."
-    
-    return f"""You are extracting line items from a medical bill. The page contains the following text:
+# Prompt with text context (for digital PDFs). The page text is sent after
+# these instructions so the instructions stay a byte-identical prefix.
+TEXT_ENHANCED_PROMPT: Final[str] = """You are extracting line items from a medical bill. The text extracted from the page follows these instructions.
 
----TEXT START---
-{extracted_text}
----TEXT END---
-
-Using BOTH the image AND the text above, extract ALL line items.
+Using BOTH the image AND the page text, extract ALL line items.
 
 OUTPUT FORMAT (JSON only):
-{{
+{
   "page_type": "Bill Detail",
   "bill_items": [
-    {{"item_name": "Full description", "item_amount": 123.45, "item_rate": 123.45, "item_quantity": 1}}
+    {"item_name": "Full description", "item_amount": 123.45, "item_rate": 123.45, "item_quantity": 1}
   ]
-}}
+}
 
 RULES:
 1. item_amount = Net/Total amount for the line (rightmost amount column)
@@ -155,87 +172,265 @@ page_type options: Pharmacy, Investigation, Consultation, Room Charges, Bill Det
 
 Return ONLY valid JSON. No explanations."""
 
+# Variable per-page part, always sent after the shared instructions
+PAGE_TEXT_SUFFIX: Final[str] = """---TEXT START---
+{page_text}
+---TEXT END---"""
 
-# Section-specific prompts
-PHARMACY_PROMPT = """Extract PHARMACY/MEDICINE items from this bill image.
+MAX_PROMPT_TEXT_CHARS = 3000
 
-Look for:
-- Tablet names (TAB, TABLET)
-- Capsules (CAP, CAPSULE)
-- Syrups (SYR, SYRUP)
-- Injections (INJ, INJECTION)
-- Drug strengths (MG, ML, MCG)
 
-OUTPUT (JSON only):
-{
-  "page_type": "Pharmacy",
-  "bill_items": [
-    {"item_name": "MEDICINE NAME WITH STRENGTH", "item_amount": 0.00, "item_rate": 0.00, "item_quantity": 1}
-  ]
-}
+def get_page_text_suffix(extracted_text: str) -> str:
+    """Format (truncated) page text as the variable prompt suffix."""
+    if len(extracted_text) > MAX_PROMPT_TEXT_CHARS:
+        extracted_text = extracted_text[:MAX_PROMPT_TEXT_CHARS] + "..."
+    return PAGE_TEXT_SUFFIX.format(page_text=extracted_text)
 
-Extract pharmacy items:"""
 
+def get_text_enhanced_prompt(extracted_text: str) -> str:
+    """Generate prompt with text context for digital PDFs."""
+    return f"{TEXT_ENHANCED_PROMPT}\n\n{get_page_text_suffix(extracted_text)}"
 
-INVESTIGATION_PROMPT = """Extract INVESTIGATION/LAB TEST items from this bill image.
+
+# Section-specific prompts share one short template; each section only
+# supplies its title, what to look for and an example item name
+_SECTION_PROMPT_TEMPLATE: Final[str] = """Extract {title} items from this bill image.
 
 Look for:
-- Blood tests (CBC, Hemoglobin, etc.)
-- Urine tests
-- Pathology reports
-- Radiology (X-Ray, CT, MRI, USG)
-- ECG, Echo, etc.
+{hints}
+
+Also include any other billed line items on the page.
 
 OUTPUT (JSON only):
-{
-  "page_type": "Investigation",
+{{
+  "page_type": "{page_type}",
   "bill_items": [
-    {"item_name": "TEST NAME", "item_amount": 0.00, "item_rate": 0.00, "item_quantity": 1}
+    {{"item_name": "{example_name}", "item_amount": 0.00, "item_rate": 0.00, "item_quantity": 1}}
   ]
-}
-
-Extract investigation items:"""
-
+}}
 
-# Prompt selector based on context
-def select_prompt(page_text: str = "", attempt: int = 1, detected_type: str = None) -> str:
+Extract {section} items:"""
+
+
+def _build_section_prompt(title: str, page_type: str, example_name: str,
+                          hints: List[str]) -> str:
+    """Fill the section template for one page type."""
+    return _SECTION_PROMPT_TEMPLATE.format(
+        title=title,
+        hints="\n".join(f"- {hint}" for hint in hints),
+        page_type=page_type,
+        example_name=example_name,
+        section=page_type.lower(),
+    )
+
+
+PHARMACY_PROMPT: Final[str] = _build_section_prompt(
+    "PHARMACY/MEDICINE", "Pharmacy", "MEDICINE NAME WITH STRENGTH",
+    [
+        "Tablet names (TAB, TABLET)",
+        "Capsules (CAP, CAPSULE)",
+        "Syrups (SYR, SYRUP)",
+        "Injections (INJ, INJECTION)",
+        "Drug strengths (MG, ML, MCG)",
+    ],
+)
+
+INVESTIGATION_PROMPT: Final[str] = _build_section_prompt(
+    "INVESTIGATION/LAB TEST", "Investigation", "TEST NAME",
+    [
+        "Blood tests (CBC, Hemoglobin, etc.)",
+        "Urine tests",
+        "Pathology reports",
+        "Radiology (X-Ray, CT, MRI, USG)",
+        "ECG, Echo, etc.",
+    ],
+)
+
+# Keywords in a detected page type that select a section prompt, in order
+_SECTION_PROMPTS = (
+    ('pharmacy', PHARMACY_PROMPT),
+    ('medicine', PHARMACY_PROMPT),
+    ('investigation', INVESTIGATION_PROMPT),
+    ('lab', INVESTIGATION_PROMPT),
+)
+
+
+# Page text markers used to route pages to a section-specific prompt
+_PHARMACY_LINE_PATTERN = re.compile(
+    r'^\s*(?:\d+[.)]?\s+)?(?:TAB|TABLET|CAP|CAPSULE|SYR|SYRUP|INJ|INJECTION)\b',
+    re.IGNORECASE | re.MULTILINE
+)
+_INVESTIGATION_PATTERN = re.compile(
+    r'\b(?:CBC|HAEMOGRAM|HEMOGLOBIN|LIPID PROFILE|URINE|X-?RAY|MRI|CT SCAN|'
+    r'USG|ULTRASOUND|ECG|ECHO|PATHOLOGY|RADIOLOGY)\b',
+    re.IGNORECASE
+)
+MIN_SECTION_MARKERS = 5
+
+
+def classify_page_text(page_text: str) -> Optional[str]:
     """
-    Select the most appropriate prompt based on context.
+    Cheaply classify a page from its text layer.
+    
+    Only returns a type when one section clearly dominates, since a
+    section prompt focuses the model on that kind of item.
     
     Args:
-        page_text: Extracted text from the page (if available)
-        attempt: Retry attempt number (1, 2, 3...)
-        detected_type: Pre-detected page type
+        page_text: Extracted text from the page
         
     Returns:
-        Selected prompt string
+        "Pharmacy", "Investigation", or None if unclear
     """
+    if not page_text:
+        return None
+    
+    pharmacy = len(_PHARMACY_LINE_PATTERN.findall(page_text))
+    investigation = len(_INVESTIGATION_PATTERN.findall(page_text))
+    
+    if pharmacy >= MIN_SECTION_MARKERS and investigation == 0:
+        return "Pharmacy"
+    if investigation >= MIN_SECTION_MARKERS and pharmacy == 0:
+        return "Investigation"
+    return None
+
+
+# Appended to section prompts when the page text is sent as well
+_PAGE_TEXT_NOTE: Final[str] = """
+
+Use BOTH the image AND the page text that follows."""
+
+
+@lru_cache(maxsize=16)
+def _get_prompt_prefix(has_text: bool, attempt: int,
+                       detected_type: Optional[str]) -> str:
+    """Select and assemble the shared instruction prefix for a page."""
     # Use retry prompt for subsequent attempts
     if attempt > 1:
         return RETRY_PROMPT
     
-    # If we have significant text, use text-enhanced prompt
-    if page_text and len(page_text) > 200:
-        return get_text_enhanced_prompt(page_text)
-    
-    # Use section-specific prompts if type is detected
+    # Use section-specific prompts if type is detected (much shorter)
     if detected_type:
         type_lower = detected_type.lower()
-        if 'pharmacy' in type_lower or 'medicine' in type_lower:
-            return PHARMACY_PROMPT
-        elif 'investigation' in type_lower or 'lab' in type_lower:
-            return INVESTIGATION_PROMPT
+        section_prompt = next(
+            (prompt for keyword, prompt in _SECTION_PROMPTS if keyword in type_lower),
+            None
+        )
+        
+        if section_prompt:
+            if has_text:
+                return section_prompt + _PAGE_TEXT_NOTE
+            return section_prompt
+    
+    # If we have significant text, use text-enhanced prompt
+    if has_text:
+        return TEXT_ENHANCED_PROMPT
     
     # Default to main prompt
     return EXTRACTION_PROMPT_V1
 
 
+# Prompt selector based on context
+def select_prompt(page_text: str = "", attempt: int = 1,
+                  detected_type: str = None) -> Tuple[str, str]:
+    """
+    Select the most appropriate prompt based on context.
+    
+    The prompt is split so that the long instructions are always a
+    byte-identical leading prefix (shared across pages, and eligible for
+    Gemini's prompt caching) and per-page content comes strictly after.
+    
+    Args:
+        page_text: Extracted text from the page (if available)
+        attempt: Retry attempt number (1, 2, 3...)
+        detected_type: Pre-detected page type
+        
+    Returns:
+        Tuple of (cacheable instruction prefix, variable suffix or "")
+    """
+    has_text = bool(page_text) and len(page_text) > 200
+    prefix = _get_prompt_prefix(has_text, attempt, detected_type)
+    
+    # Retries send the image alone with the retry prompt
+    if has_text and attempt == 1:
+        return prefix, get_page_text_suffix(page_text)
+    return prefix, ""
+
+
+# Response schemas enforced by Gemini's constrained decoding, so the
+# output is always well-formed JSON with numeric amounts
+_ITEM_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "item_name": {"type": "STRING"},
+        "item_amount": {"type": "NUMBER"},
+        "item_rate": {"type": "NUMBER", "nullable": True},
+        "item_quantity": {"type": "NUMBER", "nullable": True},
+    },
+    "required": ["item_name", "item_amount"],
+}
+
+# Same page types as parser._EXPLICIT_PAGE_TYPES and schemas.PageType
+_PAGE_TYPE_SCHEMA = {
+    "type": "STRING",
+    "format": "enum",
+    "enum": ["Bill Detail", "Pharmacy", "Final Bill", "Investigation",
+             "Consultation", "Room Charges", "Services"],
+}
+
+PAGE_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "page_type": _PAGE_TYPE_SCHEMA,
+        "bill_items": {"type": "ARRAY", "items": _ITEM_SCHEMA},
+    },
+    "required": ["page_type", "bill_items"],
+}
+
+BATCH_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "pages": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "page_no": {"type": "STRING"},
+                    "page_type": _PAGE_TYPE_SCHEMA,
+                    "bill_items": {"type": "ARRAY", "items": _ITEM_SCHEMA},
+                },
+                "required": ["page_no", "page_type", "bill_items"],
+            },
+        },
+    },
+    "required": ["pages"],
+}
+
+
+def prompt_fingerprint(*parts: str) -> bytes:
+    """
+    Short stable digest of the prompt text sent with a page.
+    
+    Args:
+        parts: Prompt pieces in the order they are sent
+        
+    Returns:
+        8-byte digest, usable in cache keys
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b'\0')
+    return digest.digest()
+
+
 # Generation config for deterministic extraction
 GENERATION_CONFIG = {
     "temperature": 0,  # Deterministic output
     "max_output_tokens": 4096,  # Allow for large responses
     "top_p": 1,
-    "top_k": 1
+    "top_k": 1,
+    "response_mime_type": "application/json",
+    "response_schema": PAGE_RESPONSE_SCHEMA
 }
 
 
@@ -244,5 +439,27 @@ RETRY_GENERATION_CONFIG = {
     "temperature": 0.1,
     "max_output_tokens": 4096,
     "top_p": 0.95,
-    "top_k": 40
-}
\ No newline at end of file
+    "top_k": 40,
+    "response_mime_type": "application/json",
+    "response_schema": PAGE_RESPONSE_SCHEMA
+}
+
+
+def select_config(attempt: int = 1) -> Dict:
+    """
+    Select the generation config for a page call.
+    
+    First attempts keep the full output budget even on short pages:
+    gemini-2.5-flash counts thinking tokens against max_output_tokens, so
+    a smaller cap can run out before any JSON is written, and it doesn't
+    make short answers finish sooner.
+    
+    Args:
+        attempt: Retry attempt number (1, 2, 3...)
+        
+    Returns:
+        A new generation config dict the caller may modify
+    """
+    if attempt > 1:
+        return dict(RETRY_GENERATION_CONFIG)
+    return dict(GENERATION_CONFIG)
\ No newline at end of file
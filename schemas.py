@@ -2,14 +2,35 @@
 schemas.py - Pydantic models and validation schemas for invoice extraction
 """
 
-from pydantic import BaseModel, Field, field_validator, model_validator
-from typing import List, Optional, Literal
+from pydantic import AfterValidator, BaseModel, ConfigDict, Field, computed_field, field_validator
+from typing import Annotated, List, Optional, Literal, Union
 from enum import Enum
+from functools import cached_property, lru_cache
+from types import MappingProxyType
 import re
+import sys
+
+
+# Leading index numbers/dots stripped from item names
+_RE_LEADING_JUNK = re.compile(r'^[\d\.\-\s]+')
+
+# Common false-positive item names (totals, serial-number headers, bare
+# numbers, separator lines), matched against the whole lowercased name
+_RE_REJECT_NAME = re.compile(
+    r'^(?:'
+    r'total|subtotal|sub-total|grand total|net amount|amount|sum'
+    r'|page|pg|sr\.?no|s\.?no|sl\.?no'
+    r'|\d+'
+    r'|[=\-_\.]+'
+    r')$',
+    re.IGNORECASE
+)
 
 
 class PageType(str, Enum):
     """Valid page types for medical invoices"""
+    # Keep in step with parser._EXPLICIT_PAGE_TYPES, the prompts.py
+    # response schema enum and main.PageTypeName
     BILL_DETAIL = "Bill Detail"
     PHARMACY = "Pharmacy"
     FINAL_BILL = "Final Bill"
@@ -17,65 +38,85 @@ class PageType(str, Enum):
     CONSULTATION = "Consultation"
     ROOM_CHARGES = "Room Charges"
     SERVICES = "Services"
-    PROCEDURE = "Procedure"
+
+
+# Variations of page types, checked as substrings in this order (read-only)
+_PAGE_TYPE_ALIASES = MappingProxyType({
+    'pharmacy': 'Pharmacy',
+    'medicine': 'Pharmacy',
+    'medicines': 'Pharmacy',
+    'drug': 'Pharmacy',
+    'final bill': 'Final Bill',
+    'final': 'Final Bill',
+    'summary': 'Final Bill',
+    'total': 'Final Bill',
+    'bill detail': 'Bill Detail',
+    'detail': 'Bill Detail',
+    'details': 'Bill Detail',
+    'investigation': 'Investigation',
+    'lab': 'Investigation',
+    'laboratory': 'Investigation',
+    'pathology': 'Investigation',
+    'radiology': 'Investigation',
+    'consultation': 'Consultation',
+    'doctor': 'Consultation',
+    'room': 'Room Charges',
+    'room charges': 'Room Charges',
+    'accommodation': 'Room Charges',
+    'bed': 'Room Charges',
+    'services': 'Services',
+    'service': 'Services',
+})
+
+# Lowercased canonical names and aliases for O(1) exact matches
+_EXACT_PAGE_TYPES = {pt.value.lower(): pt.value for pt in PageType}
+_EXACT_PAGE_TYPES.update(_PAGE_TYPE_ALIASES)
+
+
+@lru_cache(maxsize=4096)
+def _clean_name(name: str) -> str:
+    """
+    Normalize a raw item name.
+    
+    Cached and interned because the same drug or test name repeats across
+    pages, so each distinct name is cleaned and stored once.
+    """
+    # Collapse internal whitespace runs (the ends are already stripped)
+    name = ' '.join(name.split())
+    # Remove common artifacts
+    name = _RE_LEADING_JUNK.sub('', name)  # Leading numbers/dots
+    name = name.strip('.,;:-() ')
+    return sys.intern(name)
+
+
+# Range checks run inside pydantic-core; only the rounding calls back into
+# Python. Limits: 10 crore per amount, 10000 units per line.
+Money = Annotated[float, Field(ge=0, le=100_000_000), AfterValidator(lambda v: round(v, 2))]
+# Quantities are almost always whole numbers; keep them as int and only
+# fall back to float for fractional ones (e.g. 0.5 ml)
+Quantity = Annotated[Union[int, float], Field(ge=0, le=10000)]
 
 
 class ExtractedItem(BaseModel):
     """Schema for a single extracted line item with validation"""
+    # Models add stray keys (gross_amount, ...) that are dropped unvalidated;
+    # items are immutable once built, so they can be hashed for dedup
+    model_config = ConfigDict(extra='ignore', str_strip_whitespace=True, frozen=True)
+    
     item_name: str = Field(..., min_length=1, max_length=500)
-    item_amount: float = Field(..., ge=0)
-    item_rate: Optional[float] = Field(default=None, ge=0)
-    item_quantity: Optional[float] = Field(default=None, ge=0)
+    item_amount: Money
+    item_rate: Optional[Money] = None
+    item_quantity: Optional[Quantity] = None
     
     @field_validator('item_name')
     @classmethod
     def clean_item_name(cls, v: str) -> str:
         """Clean and validate item name"""
-        if not v:
-            raise ValueError("Item name cannot be empty")
-        # Remove excessive whitespace
-        v = ' '.join(v.split())
-        # Remove common artifacts
-        v = re.sub(r'^[\d\.\-\s]+', '', v)  # Leading numbers/dots
-        v = v.strip('.,;:-() ')
+        # Empty names never get here: min_length=1 runs first, after stripping
+        v = _clean_name(v)
         if len(v) < 2:
             raise ValueError("Item name too short after cleaning")
         return v
-    
-    @field_validator('item_amount', 'item_rate')
-    @classmethod
-    def validate_amount(cls, v: Optional[float]) -> Optional[float]:
-        """Validate monetary amounts"""
-        if v is None:
-            return None
-        if v < 0:
-            raise ValueError("Amount cannot be negative")
-        if v > 100_000_000:  # 10 crore sanity limit
-            raise ValueError("Amount exceeds sanity limit")
-        return round(v, 2)
-    
-    @field_validator('item_quantity')
-    @classmethod
-    def validate_quantity(cls, v: Optional[float]) -> Optional[float]:
-        """Validate quantity"""
-        if v is None:
-            return None
-        if v < 0:
-            raise ValueError("Quantity cannot be negative")
-        if v > 10000:  # Sanity limit
-            raise ValueError("Quantity exceeds sanity limit")
-        return v
-    
-    @model_validator(mode='after')
-    def validate_consistency(self):
-        """Cross-validate rate × quantity ≈ amount"""
-        if self.item_rate and self.item_quantity and self.item_amount:
-            expected = self.item_rate * self.item_quantity
-            tolerance = max(1.0, self.item_amount * 0.05)  # 5% or ₹1
-            if abs(expected - self.item_amount) > tolerance:
-                # Don't fail, but log warning - medical bills often have discounts
-                pass
-        return self
 
 
 class PageResult(BaseModel):
@@ -92,38 +133,13 @@ class PageResult(BaseModel):
         """Normalize page type to valid values"""
         v_lower = v.lower().strip()
         
-        # Map variations to standard types
-        type_mapping = {
-            'pharmacy': 'Pharmacy',
-            'medicine': 'Pharmacy',
-            'medicines': 'Pharmacy',
-            'drug': 'Pharmacy',
-            'final bill': 'Final Bill',
-            'final': 'Final Bill',
-            'summary': 'Final Bill',
-            'total': 'Final Bill',
-            'bill detail': 'Bill Detail',
-            'detail': 'Bill Detail',
-            'details': 'Bill Detail',
-            'investigation': 'Investigation',
-            'lab': 'Investigation',
-            'laboratory': 'Investigation',
-            'pathology': 'Investigation',
-            'radiology': 'Investigation',
-            'consultation': 'Consultation',
-            'doctor': 'Consultation',
-            'room': 'Room Charges',
-            'room charges': 'Room Charges',
-            'accommodation': 'Room Charges',
-            'bed': 'Room Charges',
-            'services': 'Services',
-            'service': 'Services',
-            'procedure': 'Procedure',
-            'surgery': 'Procedure',
-            'operation': 'Procedure',
-        }
+        # Exact names and aliases (the usual model output) hit the dict;
+        # only free-form text falls back to the ordered substring scan
+        exact = _EXACT_PAGE_TYPES.get(v_lower)
+        if exact:
+            return exact
         
-        for key, mapped_type in type_mapping.items():
+        for key, mapped_type in _PAGE_TYPE_ALIASES.items():
             if key in v_lower:
                 return mapped_type
         
@@ -133,16 +149,13 @@ class PageResult(BaseModel):
 class ExtractionResult(BaseModel):
     """Schema for complete extraction result"""
     pagewise_line_items: List[PageResult] = Field(default_factory=list)
-    total_item_count: int = Field(default=0, ge=0)
     extraction_metadata: dict = Field(default_factory=dict)
     
-    @model_validator(mode='after')
-    def compute_total(self):
-        """Compute total item count from pages"""
-        self.total_item_count = sum(
-            len(page.bill_items) for page in self.pagewise_line_items
-        )
-        return self
+    @computed_field
+    @cached_property
+    def total_item_count(self) -> int:
+        """Total item count across pages, computed on first access"""
+        return sum(len(page.bill_items) for page in self.pagewise_line_items)
 
 
 # Validation utilities
@@ -157,21 +170,31 @@ def is_valid_item_name(name: str) -> bool:
         return False
     
     # Reject common false positives
-    reject_patterns = [
-        r'^(total|subtotal|sub-total|grand total|net amount|amount|sum)$',
-        r'^(page|pg|sr\.?no|s\.?no|sl\.?no)$',
-        r'^\d+$',
-        r'^[=\-_\.]+$',
-    ]
-    
-    name_lower = name.lower().strip()
-    for pattern in reject_patterns:
-        if re.match(pattern, name_lower, re.IGNORECASE):
-            return False
+    if _RE_REJECT_NAME.match(name.lower().strip()):
+        return False
     
     return True
 
 
+def audit_consistency(item: ExtractedItem) -> Optional[str]:
+    """
+    Cross-check rate × quantity ≈ amount for one item.
+    
+    Not run during validation; medical bills often carry per-line
+    discounts, so a mismatch is only worth reporting in audit passes.
+    
+    Returns:
+        Description of the mismatch, or None if consistent or not checkable
+    """
+    if item.item_rate and item.item_quantity and item.item_amount:
+        expected = item.item_rate * item.item_quantity
+        tolerance = max(1.0, item.item_amount * 0.05)  # 5% or ₹1
+        if abs(expected - item.item_amount) > tolerance:
+            return (f"{item.item_name}: {item.item_rate} × {item.item_quantity} "
+                    f"= {expected:.2f} ≠ {item.item_amount}")
+    return None
+
+
 def is_reasonable_amount(amount: float, context: str = "") -> bool:
     """Check if amount is reasonable for medical bills"""
     if amount < 0:
@@ -180,4 +203,10 @@ def is_reasonable_amount(amount: float, context: str = "") -> bool:
         return False
     if amount == 0:
         return False  # Zero amounts are usually totals/headers
-    return True
\ No newline at end of file
+    return True
+
+
+# JSON schemas for prompts or constrained decoding, built once at import
+# instead of walking the model graph on every call
+EXTRACTED_ITEM_SCHEMA = ExtractedItem.model_json_schema()
+PAGE_RESULT_SCHEMA = PageResult.model_json_schema()
\ No newline at end of file